@@ -0,0 +1,58 @@
+# Picking out the people who meet min_ref_count_for_summary from --years
+# synthetic birth year files, by parsing the text files and by loading
+# their binary copies.
+
+import argparse
+import os
+import random
+
+from bench.common import cfg, timed, use_temporary_output_directory
+import wiki_by_birth_year
+
+def write_files(years, people_per_year):
+    rng = random.Random(1)
+    count = 0
+
+    for year in years:
+        fname = wiki_by_birth_year.year_to_filename(year)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        with open(fname, 'w', encoding='utf-8') as f:
+            for i in range(rng.randint(1, 2 * people_per_year)):
+                # Most people have few references and a few have very many
+                ref_count = int(rng.paretovariate(1.2)) - 1
+                wiki_by_birth_year.write_member(f'Person {year} {i}', year, ref_count, f)
+                count += 1
+
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--years', type=int, default=3000)
+    parser.add_argument('--people-per-year', type=int, default=570)
+    args = parser.parse_args()
+
+    use_temporary_output_directory()
+    years = range(2025 - args.years, 2025)
+    people = write_files(years, args.people_per_year)
+    fnames = [wiki_by_birth_year.year_to_filename(year) for year in years]
+    print(f'{people} people in {len(fnames)} files')
+
+    threshold = cfg.min_ref_count_for_summary
+    with timed('text files', people, 'people'):
+        text = sum(1 for fname in fnames
+                   for _, ref_count, _, estimated in wiki_by_birth_year.iterate_people_file(fname)
+                   if ref_count >= threshold and not estimated)
+
+    with timed('convert to binary', people, 'people'):
+        for fname in fnames:
+            wiki_by_birth_year.convert_people_file(fname)
+
+    with timed('binary files', people, 'people'):
+        binary = sum(1 for fname in fnames
+                     for _ in wiki_by_birth_year.load_people_columns(fname).above(threshold))
+
+    print(f'{text} people with at least {threshold} references; counts match:', text == binary)
+
+if __name__ == '__main__':
+    main()
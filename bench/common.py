@@ -0,0 +1,52 @@
+# Shared setup for the benchmarks.  Run them from the repository root, e.g.
+#   python -m bench.crawl
+#
+# Each benchmark works in a temporary output directory, so it never touches
+# results/, and talks to a tests/stub_server.py StubWiki instead of
+# Wikipedia.
+
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# config.yaml is read from the working directory
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from config import cfg
+import db_wrapper
+import rate_limiter
+from stub_server import StubWiki
+
+# Points cfg at a fresh output directory and people.db
+def use_temporary_output_directory():
+    cfg.output_directory = tempfile.mkdtemp(prefix='wiki-people-bench-')
+    db_wrapper.close_connection()
+    db_wrapper.initialize_tables()
+    return cfg.output_directory
+
+# Starts a StubWiki and sends API requests to it, with the response cache
+# and the request rate limit off so that only the code is measured
+def start_stub_wiki(latency):
+    wiki = StubWiki(latency).start()
+    cfg.api_url = wiki.api_url
+    cfg.http_cache_enabled = False
+    rate_limiter.api.bucket.rate = 0
+    return wiki
+
+# Sets the concurrency limit of the requests to the API
+def set_max_concurrent_requests(limit):
+    cfg.max_concurrent_requests = limit
+    rate_limiter.api.concurrency = rate_limiter.AdaptiveConcurrency(limit)
+
+@contextmanager
+def timed(label, count, unit):
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    print(f'{label:<40} {seconds:8.2f}s {count / seconds:10.1f} {unit}/s')
@@ -0,0 +1,71 @@
+# Crawl throughput of write_birth_year_file against a StubWiki whose every
+# response takes --latency seconds, compared with the original crawl that
+# asked for one title's reference count at a time.
+
+import argparse
+import os
+
+from bench.common import cfg, start_stub_wiki, set_max_concurrent_requests, timed, \
+    use_temporary_output_directory
+import wiki_api
+import wiki_by_birth_year
+
+YEAR = 1960
+
+# The crawl as it was before it was batched: one request per member
+def crawl_one_title_at_a_time(year):
+    fname = wiki_by_birth_year.year_to_filename(year)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    cont = None
+
+    with open(fname, 'w', encoding='utf-8') as myfile:
+        while True:
+            titles, cont = wiki_api.get_category_members(
+                wiki_by_birth_year.year_to_category_name(year), cont)
+            for title in titles:
+                ref_count = wiki_by_birth_year.get_reference_count(title)
+                wiki_by_birth_year.write_member(title, year, ref_count, myfile)
+
+            if cont is None:
+                break
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--people', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    use_temporary_output_directory()
+    wiki = start_stub_wiki(args.latency)
+    for i in range(args.people):
+        wiki.add_person(f'Person {i}', YEAR, ref_count=i % 200)
+
+    cfg.crawl_prefilter = False
+    cfg.birth_year_binary_files = False
+    fname = wiki_by_birth_year.year_to_filename(YEAR)
+
+    # Only run the original crawl on a sample; it is far too slow otherwise
+    sample = min(args.people, 200)
+    wiki.categories[wiki_by_birth_year.year_to_category_name(YEAR + 1)] = \
+        wiki.categories[wiki_by_birth_year.year_to_category_name(YEAR)][:sample]
+    with timed(f'one title per request ({sample} people)', sample, 'people'):
+        crawl_one_title_at_a_time(YEAR + 1)
+
+    files = []
+    for limit in args.concurrency:
+        set_max_concurrent_requests(limit)
+        if os.path.exists(fname):
+            os.remove(fname)
+
+        with timed(f'batched, {limit} concurrent requests', args.people, 'people'):
+            wiki_by_birth_year.write_birth_year_file(YEAR)
+
+        with open(fname, 'rb') as f:
+            files.append(f.read())
+
+    print('Files identical:', all(f == files[0] for f in files))
+    wiki.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# The cost of opening a sqlite connection for every DBManager block, as
+# db_wrapper did originally, against reusing the thread's connection.
+#
+# Times the queries of --details for --people people, and inserting them
+# one row per block (committing each) and in batches of
+# summary_insert_batch_size rows committed with db_wrapper.commit().
+
+import argparse
+import contextlib
+import io
+import sqlite3
+
+from bench.common import cfg, timed, use_temporary_output_directory
+import db_wrapper
+import wiki_summary
+
+INSERT = '''
+    insert into people (title, birth_year, reference_count, summary, summary_status)
+    values (?, 1950, 100, ?, 'ok')
+    '''
+
+# db_wrapper.DBManager as it was: a new connection for every block,
+# committed and closed when the block exits
+class PerCallDBManager():
+    def __enter__(self):
+        self.conn = sqlite3.connect(f'{cfg.output_directory}/people.db')
+        return self.conn.cursor()
+
+    def __exit__(self, type, value, traceback):
+        self.conn.commit()
+        self.conn.close()
+
+def rows(start, count):
+    return [(f'Person {i}', f'Person {i} was an American actor and singer.')
+            for i in range(start, start + count)]
+
+def insert_one_per_block(manager, rows):
+    for row in rows:
+        with manager() as cur:
+            cur.execute(INSERT, row)
+
+def insert_in_batches(rows):
+    with db_wrapper.DBManager() as cur:
+        for start in range(0, len(rows), cfg.summary_insert_batch_size):
+            cur.executemany(INSERT, rows[start:start + cfg.summary_insert_batch_size])
+            db_wrapper.commit(cur)
+
+def print_all_details(manager, count):
+    original = db_wrapper.DBManager
+    db_wrapper.DBManager = manager
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(count):
+                wiki_summary.print_details(f'Person {i}')
+    finally:
+        db_wrapper.DBManager = original
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--people', type=int, default=5000)
+    args = parser.parse_args()
+
+    use_temporary_output_directory()
+    count = args.people
+
+    with timed('insert, connection per row', count, 'rows'):
+        insert_one_per_block(PerCallDBManager, rows(0, count))
+    with timed('insert, shared connection per row', count, 'rows'):
+        insert_one_per_block(db_wrapper.DBManager, rows(count, count))
+    with timed(f'insert, {cfg.summary_insert_batch_size} rows per commit', count, 'rows'):
+        insert_in_batches(rows(2 * count, count))
+
+    with timed('--details, connection per block', count, 'lookups'):
+        print_all_details(PerCallDBManager, count)
+    with timed('--details, shared connection', count, 'lookups'):
+        print_all_details(db_wrapper.DBManager, count)
+
+if __name__ == '__main__':
+    main()
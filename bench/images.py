@@ -0,0 +1,48 @@
+# Image download throughput of get_images against a StubWiki whose every
+# response, API or image, takes --latency seconds, with different numbers
+# of download workers.
+
+import argparse
+
+from bench.common import cfg, start_stub_wiki, set_max_concurrent_requests, timed, \
+    use_temporary_output_directory
+import db_wrapper
+import image_retriever
+import image_store
+import rate_limiter
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--people', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--storage', choices=['files', 'blob'], default='files')
+    args = parser.parse_args()
+
+    wiki = start_stub_wiki(args.latency)
+    titles = [f'Person {i}' for i in range(args.people)]
+    for title in titles:
+        wiki.add_person(title, 1950, ref_count=10)
+
+    cfg.image_url_source = 'pageimages'
+    cfg.image_storage = args.storage
+    image_retriever.download_gate.bucket.rate = 0
+    set_max_concurrent_requests(4)
+
+    for workers in args.workers:
+        use_temporary_output_directory()
+        image_store.conn = None
+        with db_wrapper.DBManager() as cur:
+            cur.executemany("insert into people (title, birth_year, reference_count, summary) "
+                            "values (?, 1950, 10, '')", ((title,) for title in titles))
+
+        cfg.image_download_workers = workers
+        image_retriever.download_gate.concurrency = rate_limiter.AdaptiveConcurrency(workers)
+
+        with timed(f'{workers} download workers ({args.storage})', args.people, 'images'):
+            image_retriever.get_images()
+
+    wiki.stop()
+
+if __name__ == '__main__':
+    main()
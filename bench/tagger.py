@@ -0,0 +1,59 @@
+# Profession tagging of a synthetic database of --people people, with the
+# single pass KeywordMatcher tagger and with the original LIKE query per
+# keyword.  Both must assign the same professions.
+
+import argparse
+import random
+
+from bench.common import timed, use_temporary_output_directory
+import db_wrapper
+import professions
+
+FILLER = ['was', 'an', 'American', 'born', 'in', 'the', 'and', 'who', 'known', 'for', 'his', 'her',
+          'work', 'on', 'of', 'a', 'British', 'French', 'German', 'early', 'career', 'later']
+
+def create_people(count, keywords):
+    rng = random.Random(1)
+    words = FILLER * 20 + [keyword for keyword, _ in keywords]
+
+    with db_wrapper.DBManager() as cur:
+        cur.executemany('insert into people (title, birth_year, reference_count, summary) values (?, ?, ?, ?)',
+                        ((f'Person {i}', 1900 + i % 100, 100,
+                          f'Person {i} ' + ' '.join(rng.choice(words) for _ in range(60)))
+                         for i in range(count)))
+
+def tag_with_like(cur, keywords):
+    for keyword, profession in keywords:
+        cur.execute('''
+            insert or ignore into people_to_profession
+            select title, ? from people
+            where substr(summary, 1, 300) like ?
+            ''', (profession, f'%{keyword}%'))
+
+def tag_in_one_pass(cur, keywords):
+    professions.tag_people(cur, keywords, '1')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--people', type=int, default=100000)
+    args = parser.parse_args()
+
+    use_temporary_output_directory()
+    keywords, _ = professions.load_keywords()
+    create_people(args.people, keywords)
+
+    results = []
+    for label, tag in ((f'LIKE, one query per keyword ({len(keywords)})', tag_with_like),
+                       ('single pass KeywordMatcher', tag_in_one_pass)):
+        with db_wrapper.DBManager() as cur:
+            cur.execute('delete from people_to_profession')
+
+            with timed(label, args.people, 'people'):
+                tag(cur, keywords)
+
+            results.append(set(cur.execute('select title, profession from people_to_profession')))
+
+    print(f'{len(results[0])} professions assigned; identical:', results[0] == results[1])
+
+if __name__ == '__main__':
+    main()
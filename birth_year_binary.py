@@ -0,0 +1,128 @@
+# A compact binary version of the birth year files.
+#
+# The text files hold one '<ref_count> <year> |<title>' line per person.
+# The binary file holds the same people in columns, so that the people
+# who meet a reference count threshold can be picked out without parsing
+# or decoding the ones who don't:
+#
+#   magic     b'WPBY'
+#   version   uint32
+#   count     uint32
+#   ref_count int32[count]
+#   year      int32[count]
+#   flags     uint8[count]        see ESTIMATED
+#   offset    uint32[count + 1]   byte offsets of each title in 'titles'
+#   titles    utf-8 bytes
+#
+# All integers are little-endian.  Only files of the current VERSION can
+# be read; a copy in any other format has to be converted again from its
+# text file.
+
+import os
+import struct
+import sys
+from array import array
+from itertools import compress
+
+MAGIC = b'WPBY'
+VERSION = 2
+header = struct.Struct('<4sII')
+
+# Set in flags for people whose reference count was not counted but
+# estimated by the crawl's prefilter.  Their ref_count is an upper bound.
+ESTIMATED = 1
+
+class PeopleColumns():
+    def __init__(self, ref_counts, years, flags, offsets, titles):
+        self.ref_counts = ref_counts
+        self.years = years
+        self.flags = flags
+        self.offsets = offsets
+        self.titles = titles
+
+    # 'rows' are (title, ref_count, year, estimated)
+    @classmethod
+    def from_rows(cls, rows):
+        ref_counts = array('i')
+        years = array('i')
+        flags = array('B')
+        offsets = array('I', [0])
+        titles = bytearray()
+
+        for title, ref_count, year, estimated in rows:
+            ref_counts.append(ref_count)
+            years.append(year)
+            flags.append(ESTIMATED if estimated else 0)
+            titles += title.encode('utf-8')
+            offsets.append(len(titles))
+
+        return cls(ref_counts, years, flags, offsets, bytes(titles))
+
+    def __len__(self):
+        return len(self.ref_counts)
+
+    def title(self, i):
+        return self.titles[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def estimated(self, i):
+        return bool(self.flags[i] & ESTIMATED)
+
+    # Generator which yields (title, ref_count, year) for the people whose
+    # reference count is known to be at least min_ref_count.  Only their
+    # titles are decoded.
+    def above(self, min_ref_count):
+        selected = compress(range(len(self)), map(min_ref_count.__le__, self.ref_counts))
+        for i in selected:
+            if not self.estimated(i):
+                yield (self.title(i), self.ref_counts[i], self.years[i])
+
+    # Returns how many people have an estimated reference count of at least
+    # min_ref_count, i.e. might meet it
+    def estimated_above(self, min_ref_count):
+        return sum(1 for ref_count, flags in zip(self.ref_counts, self.flags)
+                   if flags & ESTIMATED and ref_count >= min_ref_count)
+
+    # Generator which yields (title, ref_count, year, estimated) for everyone
+    def __iter__(self):
+        for i in range(len(self)):
+            yield (self.title(i), self.ref_counts[i], self.years[i], self.estimated(i))
+
+def write_file(fname, columns):
+    with open(fname + '.tmp', 'wb') as f:
+        f.write(header.pack(MAGIC, VERSION, len(columns)))
+        for column in (columns.ref_counts, columns.years, columns.flags, columns.offsets):
+            write_array(f, column)
+        f.write(columns.titles)
+
+    # Replace atomically so a reader never sees half a file
+    os.replace(fname + '.tmp', fname)
+
+def read_file(fname):
+    with open(fname, 'rb') as f:
+        magic, version, count = header.unpack(f.read(header.size))
+        if magic != MAGIC:
+            raise ValueError(f'{fname} is not a binary birth year file')
+        if version != VERSION:
+            raise ValueError(f'{fname} is a version {version} birth year file, but only version '
+                             f'{VERSION} can be read; delete it and run --convert-birth-year-files')
+
+        ref_counts = read_array(f, 'i', count)
+        years = read_array(f, 'i', count)
+        flags = read_array(f, 'B', count)
+        offsets = read_array(f, 'I', count + 1)
+        titles = f.read()
+
+    return PeopleColumns(ref_counts, years, flags, offsets, titles)
+
+def write_array(f, column):
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    column.tofile(f)
+
+def read_array(f, typecode, count):
+    column = array(typecode)
+    column.fromfile(f, count)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
@@ -1,46 +1,341 @@
+
 # The DBManager class should be used as a context manager
-# to connect to the sqlite DB and get a cursor.
-# The transaction is committed and the connection is closed
-# down upon exiting the context.
+# to get a cursor on the sqlite DB.
+# The transaction is committed upon exiting the outermost context.
+#
+# Connections are opened once per thread and reused for the life of the
+# process, with the PRAGMAs below applied when they are opened.  Use
+# Transaction instead of DBManager for a block whose changes should be
+# rolled back if it raises.  A long DBManager block may call commit() to
+# keep the batches it has written so far if the run is interrupted.
 
 import sqlite3
+import threading
+import metrics
 from config import cfg 
 
-class DBManager():
-    def __init__(self):
-        self.file=f'{cfg.output_directory}/people.db'
+local = threading.local()
+
+# Records how long each commit takes in the run's metrics
+class TimedConnection(sqlite3.Connection):
+    def commit(self):
+        with metrics.timer('db_commit_seconds'):
+            super().commit()
+
+def get_connection():
+    conn = getattr(local, 'conn', None)
+
+    if conn is None:
+        conn = sqlite3.connect(f'{cfg.output_directory}/people.db', timeout=cfg.db_busy_timeout,
+                               factory=TimedConnection)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size={int(cfg.db_cache_size)}')
+        conn.execute(f'PRAGMA mmap_size={int(cfg.db_mmap_size)}')
+        local.conn = conn
+        local.depth = 0
+        local.transactions = 0
+
+    return conn
+
+# Closes this thread's connection, committing anything outstanding
+def close_connection():
+    conn = getattr(local, 'conn', None)
 
+    if conn is not None:
+        conn.commit()
+        conn.close()
+        local.conn = None
+
+# For a process forked while this thread had a connection open.  sqlite
+# connections must not be used across fork(), so the inherited one is
+# dropped and a new one is opened on first use.  It is returned rather
+# than closed, since closing it would act on the parent's database state;
+# the caller keeps it referenced so it is never garbage collected either.
+def abandon_connection():
+    conn = getattr(local, 'conn', None)
+    local.conn = None
+    local.depth = 0
+    local.transactions = 0
+    return conn
+
+# Commits what a DBManager block has written so far, e.g. after each
+# batch.  Not allowed inside a Transaction, whose changes are kept or
+# rolled back all together.
+def commit(cur):
+    if local.transactions:
+        raise RuntimeError('commit() called inside a Transaction')
+    cur.connection.commit()
+
+class DBManager():
     def __enter__(self):
-        self.conn = sqlite3.connect(self.file)
+        self.conn = get_connection()
+        local.depth += 1
         return self.conn.cursor()
 
     def __exit__(self, type, value, traceback):
+        local.depth -= 1
+        if local.depth > 0:
+            return
+
         self.conn.commit()
-        self.conn.close()
 
-# Creates the necessary sqlite tables if they don't already exist
+# The outermost Transaction begins a transaction explicitly, so that schema
+# changes are rolled back too.  One entered while a transaction is already
+# open, e.g. inside another context, uses a SAVEPOINT instead, so that only
+# its own changes are rolled back and the enclosing ones are kept.
+class Transaction(DBManager):
+    def __enter__(self):
+        cur = super().__enter__()
+        self.savepoint = None
+
+        if self.conn.in_transaction:
+            self.savepoint = f'transaction_{local.depth}'
+            self.conn.execute(f'SAVEPOINT {self.savepoint}')
+        else:
+            self.conn.execute('BEGIN')
+
+        local.transactions += 1
+        return cur
+
+    def __exit__(self, type, value, traceback):
+        local.transactions -= 1
+
+        if self.savepoint is not None:
+            if type is not None:
+                self.conn.execute(f'ROLLBACK TO {self.savepoint}')
+            self.conn.execute(f'RELEASE {self.savepoint}')
+        elif type is not None:
+            self.conn.rollback()
+
+        super().__exit__(type, value, traceback)
+
+# Schema migrations.  Entry N upgrades a database from schema version N to
+# N + 1; the current version is stored in PRAGMA user_version.  Append new
+# migrations to the end and never change one that has already shipped.
+MIGRATIONS = [
+    # 1: the original tables
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS people (
+            title TEXT PRIMARY KEY,
+            birth_year INTEGER NOT NULL,
+            reference_count INTEGER NOT NULL,
+            summary TEXT,
+            image_fname TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS people_to_profession (
+            title TEXT,
+            profession TEXT,
+            UNIQUE(title, profession)
+        )
+        ''',
+    ],
+    # 2: indexes for the profession, reference count, birth year and
+    # missing image lookups
+    [
+        'CREATE INDEX IF NOT EXISTS people_to_profession_profession ON people_to_profession(profession, title)',
+        'CREATE INDEX IF NOT EXISTS people_reference_count ON people(reference_count)',
+        'CREATE INDEX IF NOT EXISTS people_birth_year ON people(birth_year)',
+        'CREATE INDEX IF NOT EXISTS people_missing_image ON people(title) WHERE image_fname IS NULL',
+    ],
+    # 3: bookkeeping for incremental profession assignment
+    [
+        'ALTER TABLE people ADD COLUMN tagged_at REAL',
+        'CREATE INDEX IF NOT EXISTS people_untagged ON people(title) WHERE tagged_at IS NULL',
+        '''
+        CREATE TABLE IF NOT EXISTS applied_keywords (
+            keyword TEXT,
+            profession TEXT,
+            UNIQUE(keyword, profession)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS run_state (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''',
+    ],
+    # 4: per-year job state for the --summary scheduler.  state is one of
+    # pending, crawling, summarizing, done or failed.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS year_jobs (
+            year INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at REAL NOT NULL DEFAULT 0
+        )
+        ''',
+    ],
+    # 5: the global reference count index over all birth year files
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ref_count_index (
+            ref_count INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            title TEXT NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS ref_count_index_ref_count ON ref_count_index(ref_count, year)',
+        'CREATE INDEX IF NOT EXISTS ref_count_index_year ON ref_count_index(year)',
+        '''
+        CREATE TABLE IF NOT EXISTS ref_count_histogram (
+            year INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL,
+            people INTEGER NOT NULL,
+            PRIMARY KEY(year, ref_count)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ref_count_indexed_years (
+            year INTEGER PRIMARY KEY,
+            mtime REAL NOT NULL
+        )
+        ''',
+    ],
+    # 6: full-text search over people's titles and summaries, kept in sync
+    # with the people table by triggers.  people_fts refers to people by
+    # rowid, which VACUUM may renumber since people has no INTEGER PRIMARY
+    # KEY, so people.db must only be vacuumed with vacuum() below.
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS people_fts
+        USING fts5(title, summary, content='people', content_rowid='rowid')
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS people_fts_insert AFTER INSERT ON people BEGIN
+            INSERT INTO people_fts(rowid, title, summary) VALUES (new.rowid, new.title, new.summary);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS people_fts_delete AFTER DELETE ON people BEGIN
+            INSERT INTO people_fts(people_fts, rowid, title, summary)
+            VALUES ('delete', old.rowid, old.title, old.summary);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS people_fts_update AFTER UPDATE OF title, summary ON people BEGIN
+            INSERT INTO people_fts(people_fts, rowid, title, summary)
+            VALUES ('delete', old.rowid, old.title, old.summary);
+            INSERT INTO people_fts(rowid, title, summary) VALUES (new.rowid, new.title, new.summary);
+        END
+        ''',
+        "INSERT INTO people_fts(people_fts) VALUES ('rebuild')",
+    ],
+    # 7: fetch status of each person's summary and image, so failures can be
+    # retried.  summary_status is ok, redirect, missing or error and
+    # image_status is ok, none or error; *_error holds the class of the
+    # last error.  Existing rows get a status guessed from what was stored.
+    [
+        'ALTER TABLE people ADD COLUMN summary_status TEXT',
+        'ALTER TABLE people ADD COLUMN summary_attempts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE people ADD COLUMN summary_error TEXT',
+        'ALTER TABLE people ADD COLUMN image_status TEXT',
+        'ALTER TABLE people ADD COLUMN image_attempts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE people ADD COLUMN image_error TEXT',
+        '''
+        UPDATE people SET
+            summary_attempts = 1,
+            summary_status = CASE WHEN coalesce(summary, '') != '' THEN 'ok' ELSE 'error' END
+        ''',
+        '''
+        UPDATE people SET
+            image_attempts = 1,
+            image_status = CASE
+                WHEN image_fname LIKE 'http%' THEN 'error'
+                WHEN image_fname IN ('no image available', 'no infobox', 'bad url')
+                     OR image_fname LIKE 'bad suffix:%' OR image_fname LIKE 'bad end:%' THEN 'none'
+                ELSE 'ok'
+            END
+        WHERE image_fname IS NOT NULL
+        ''',
+        "CREATE INDEX IF NOT EXISTS people_summary_retry ON people(title) WHERE summary_status IN ('redirect', 'error')",
+        "CREATE INDEX IF NOT EXISTS people_image_retry ON people(title) WHERE image_status = 'error'",
+    ],
+    # 8: every title seen, mapped to the canonical title and id of the page
+    # it ends up at after redirects.  Redirects to a section of another
+    # page are not followed, since that page is usually about someone else.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS title_aliases (
+            alias TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            pageid INTEGER NOT NULL,
+            resolved_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS title_aliases_title ON title_aliases(title)',
+    ],
+    # 9: people whose reference count was only estimated by the crawl's
+    # prefilter.  They are left out of ref_count_histogram.
+    [
+        'ALTER TABLE ref_count_index ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS ref_count_index_estimated ON ref_count_index(ref_count) WHERE estimated',
+    ],
+    # 10: the id and latest revision of each person's page when it was
+    # fetched, for --refresh.  image_status 'stale' marks images to fetch
+    # again because the page changed.
+    [
+        'ALTER TABLE people ADD COLUMN pageid INTEGER',
+        'ALTER TABLE people ADD COLUMN lastrevid INTEGER',
+        "CREATE INDEX IF NOT EXISTS people_image_stale ON people(title) WHERE image_status = 'stale'",
+    ],
+    # 11: how many people in each year have at least each reference count,
+    # so a threshold is one lookup per year instead of a sum
+    [
+        'ALTER TABLE ref_count_histogram ADD COLUMN at_least INTEGER NOT NULL DEFAULT 0',
+        '''
+        UPDATE ref_count_histogram SET at_least = totals.at_least
+        FROM (
+            SELECT year, ref_count,
+                   sum(people) OVER (PARTITION BY year ORDER BY ref_count DESC) AS at_least
+            FROM ref_count_histogram
+        ) AS totals
+        WHERE ref_count_histogram.year = totals.year AND ref_count_histogram.ref_count = totals.ref_count
+        ''',
+    ],
+]
+
+# Creates the necessary sqlite tables if they don't already exist, and
+# upgrades existing databases in place to the latest schema version
 def initialize_tables():
     with DBManager() as cur:
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS people (
-                title TEXT PRIMARY KEY,
-                birth_year INTEGER NOT NULL,
-                reference_count INTEGER NOT NULL,
-                summary TEXT,
-                image_fname TEXT
-            )
-        ''')
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS people_to_profession (
-                title TEXT,
-                profession TEXT,
-                UNIQUE(title, profession)
-            )
-        ''')
+        version = cur.execute('PRAGMA user_version').fetchone()[0]
+
+    # Each migration is applied in its own transaction
+    for number in range(version, len(MIGRATIONS)):
+        print(f'Upgrading database schema to version {number + 1}')
+        with Transaction() as cur:
+            for statement in MIGRATIONS[number]:
+                cur.execute(statement)
+            cur.execute(f'PRAGMA user_version = {number + 1}')
+
+# Compacts people.db, then rebuilds the full-text index, since VACUUM may
+# have renumbered the rowids of the people table it refers to
+def vacuum():
+    conn = get_connection()
+    conn.commit()
+
+    print('Vacuuming people.db')
+    conn.execute('VACUUM')
+    conn.execute("INSERT INTO people_fts(people_fts) VALUES ('rebuild')")
+    conn.commit()
 
 def get_people_count():
     with DBManager() as cur:
         res = cur.execute("select count(title) from people")
         count = res.fetchone()[0]
         return int(count)
+
+# Small named values that need to survive between runs
+def get_state(cur, name):
+    row = cur.execute("select value from run_state where name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+def set_state(cur, name, value):
+    cur.execute("insert or replace into run_state values (?, ?)", (name, value))
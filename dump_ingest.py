@@ -0,0 +1,413 @@
+# Builds the people table from a Wikipedia database dump instead of the
+# live API.
+#
+# The pages-articles XML dump is parsed as a stream, one <page> at a time,
+# so memory use doesn't grow with the size of the dump.  Articles in one of
+# the birth year categories year_to_category_name knows about are kept.
+# Their reference count is the number of <ref> tags in the wikitext, and
+# their summary is the plain text of the lead section.
+#
+# Birth year categories are read from the wikitext, or from the
+# categorylinks SQL dump if one is given, which also catches categories
+# added by templates.
+#
+# Multistream dumps are made of many independent bz2 streams of 100 pages
+# each.  Given the dump's index file, the streams are split between
+# dump_workers processes and parsed in parallel.
+#
+# Everyone found is added to the reference count index.  People who meet
+# min_ref_count_for_summary are inserted into the people table, in batches
+# of dump_insert_batch_size.
+
+import bz2
+import gzip
+import html
+import io
+import multiprocessing
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import db_wrapper
+import metrics
+import ref_count_index
+import wiki_by_birth_year
+
+from config import cfg
+
+category_link_pattern = re.compile(r'\[\[\s*Category\s*:\s*([^\]|]+)', re.IGNORECASE)
+ref_pattern = re.compile(r'<ref[\s>/]', re.IGNORECASE)
+heading_pattern = re.compile(r'^=.*=\s*$', re.MULTILINE)
+
+comment_pattern = re.compile(r'<!--.*?-->', re.DOTALL)
+ref_content_pattern = re.compile(r'<ref[^>/]*/>|<ref[^>]*>.*?</ref\s*>', re.IGNORECASE | re.DOTALL)
+external_link_pattern = re.compile(r'\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]')
+tag_pattern = re.compile(r'<[^>]+>')
+bold_italic_pattern = re.compile(r"'{2,}")
+spaces_pattern = re.compile(r'[ \t]+')
+
+# cl_from and cl_to of each row in the categorylinks INSERT statements
+categorylinks_row_pattern = re.compile(r"\((\d+),'((?:[^'\\]|\\.)*)'")
+
+# Link targets that are not part of the text
+hidden_link_prefixes = ('file:', 'image:', 'category:')
+
+# Birth year category name, as it appears in categorylinks -> year
+birth_categories = {}
+
+# Page id -> birth year, from the categorylinks dump.  Set before the
+# worker processes are forked so they share it.
+years_by_pageid = {}
+
+def ingest_dump(dump_fname, index_fname=None, categorylinks_fname=None):
+    global years_by_pageid
+
+    load_birth_categories()
+
+    if categorylinks_fname:
+        years_by_pageid = load_categorylinks(categorylinks_fname)
+        print(f'Found {len(years_by_pageid)} pages in birth year categories in {categorylinks_fname}')
+
+    if index_fname:
+        results = parse_streams_in_parallel(dump_fname, index_fname)
+    else:
+        results = parse_dump(dump_fname)
+
+    load_people(results)
+
+def load_birth_categories():
+    years = list(range(-1200, 2051)) + [3000, 3001, 3002]
+    for year in years:
+        name = wiki_by_birth_year.year_to_category_name(year)
+        birth_categories[to_category_key(name.partition(':')[2])] = year
+
+# Category names are stored with underscores and a capital first letter
+def to_category_key(name):
+    name = name.strip().replace(' ', '_')
+    return name[:1].upper() + name[1:]
+
+# Returns a dict of page id -> birth year for every page in a birth year
+# category, read from a categorylinks.sql.gz dump a line at a time
+def load_categorylinks(fname):
+    years = {}
+
+    with gzip.open(fname, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.startswith('INSERT INTO'):
+                continue
+
+            for pageid, category in categorylinks_row_pattern.findall(line):
+                year = birth_categories.get(category.replace("\\'", "'"))
+                if year is not None:
+                    years.setdefault(int(pageid), year)
+
+    return years
+
+# Generator which yields lists of people rows from a whole dump, parsed in
+# this process
+def parse_dump(dump_fname):
+    rows = []
+
+    with bz2.open(dump_fname, 'rb') as f:
+        for page in iterate_pages(f):
+            row = to_person(*page)
+            if row:
+                rows.append(row)
+
+            if len(rows) >= cfg.dump_insert_batch_size:
+                yield rows
+                rows = []
+
+    yield rows
+
+# Generator which yields lists of people rows, parsing dump_streams_per_task
+# of the dump's bz2 streams at a time in each of dump_workers processes
+def parse_streams_in_parallel(dump_fname, index_fname):
+    offsets = read_stream_offsets(index_fname)
+    bounds = offsets + [os.path.getsize(dump_fname)]
+
+    step = cfg.dump_streams_per_task
+    tasks = [(dump_fname, bounds[i], bounds[min(i + step, len(offsets))])
+             for i in range(0, len(offsets), step)]
+    print(f'Parsing {len(offsets)} streams in {len(tasks)} tasks')
+
+    # The workers only parse; they never use the DB
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=cfg.dump_workers, mp_context=context) as pool:
+        running = set()
+
+        for task in tasks:
+            running.add(pool.submit(parse_streams, *task))
+
+            # Don't let parsed rows pile up faster than they are loaded
+            while len(running) >= cfg.dump_workers * 2:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        for future in wait(running).done:
+            yield future.result()
+
+# Returns the sorted, distinct stream offsets in a multistream index, whose
+# lines are <offset>:<page id>:<title>
+def read_stream_offsets(index_fname):
+    offsets = set()
+
+    with bz2.open(index_fname, 'rt', encoding='utf-8') as f:
+        for line in f:
+            offsets.add(int(line.partition(':')[0]))
+
+    return sorted(offsets)
+
+# Returns the people rows of the pages in bytes [start, end) of the dump,
+# which must be whole bz2 streams.  Runs in a worker process.
+def parse_streams(dump_fname, start, end):
+    with open(dump_fname, 'rb') as f:
+        f.seek(start)
+        data = bz2.decompress(f.read(end - start))
+
+    # The streams hold a run of <page> elements, but the first and last
+    # streams of the dump also hold the start and end of the document
+    first = data.find(b'<page>')
+    last = data.rfind(b'</page>')
+    if first == -1 or last == -1:
+        return []
+
+    fragment = b'<pages>' + data[first:last + len(b'</page>')] + b'</pages>'
+
+    rows = []
+    for page in iterate_pages(io.BytesIO(fragment)):
+        row = to_person(*page)
+        if row:
+            rows.append(row)
+
+    print(f'Parsed bytes {start} to {end}: {len(rows)} people')
+    sys.stdout.flush()
+
+    return rows
+
+# Generator which yields (title, namespace, page id, is redirect, revision
+# id, wikitext) for each <page> in an XML file object.  Each page is
+# discarded once it has been yielded.
+def iterate_pages(f):
+    root = None
+
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = elem
+
+        if event != 'end' or local_name(elem.tag) != 'page':
+            continue
+
+        title = None
+        ns = None
+        pageid = None
+        redirect = False
+        revid = None
+        text = ''
+
+        for child in elem:
+            name = local_name(child.tag)
+            if name == 'title':
+                title = child.text
+            elif name == 'ns':
+                ns = int(child.text)
+            elif name == 'id':
+                pageid = int(child.text)
+            elif name == 'redirect':
+                redirect = True
+            elif name == 'revision':
+                for part in child:
+                    if local_name(part.tag) == 'id':
+                        revid = int(part.text)
+                    elif local_name(part.tag) == 'text':
+                        text = part.text or ''
+
+        yield (title, ns, pageid, redirect, revid, text)
+
+        root.clear()
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+# Returns (title, pageid, revid, year, ref_count, summary) if the page is
+# about a person born in a known year, otherwise None.  summary is only
+# extracted for people who meet min_ref_count_for_summary, and is None for
+# the rest.
+def to_person(title, ns, pageid, redirect, revid, text):
+    if ns != 0 or redirect:
+        return None
+
+    year = years_by_pageid.get(pageid)
+    if year is None:
+        for name in category_link_pattern.findall(text):
+            year = birth_categories.get(to_category_key(name))
+            if year is not None:
+                break
+
+    if year is None:
+        return None
+
+    ref_count = len(ref_pattern.findall(text))
+
+    summary = None
+    if ref_count >= cfg.min_ref_count_for_summary:
+        summary = get_lead_text(text)
+
+    return (title, pageid, revid, year, ref_count, summary)
+
+# Returns the lead section of 'text' as plain text, roughly as the API's
+# extracts would give it
+def get_lead_text(text):
+    heading = heading_pattern.search(text)
+    if heading:
+        text = text[:heading.start()]
+
+    text = comment_pattern.sub('', text)
+    text = ref_content_pattern.sub('', text)
+    text = remove_nested(text, '{{', '}}')
+    text = remove_nested(text, '{|', '|}')
+    text = replace_links(text)
+    text = external_link_pattern.sub(r'\1', text)
+    text = tag_pattern.sub('', text)
+    text = bold_italic_pattern.sub('', text)
+    text = html.unescape(text)
+
+    lines = (spaces_pattern.sub(' ', line).strip() for line in text.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+# Removes everything between 'start' and 'end', which may be nested
+def remove_nested(text, start, end):
+    parts = []
+    depth = 0
+    i = 0
+    kept_from = 0
+
+    while True:
+        next_start = text.find(start, i)
+        next_end = text.find(end, i) if depth else -1
+
+        if next_start == -1 and next_end == -1:
+            break
+
+        if next_end == -1 or (next_start != -1 and next_start < next_end):
+            if depth == 0:
+                parts.append(text[kept_from:next_start])
+            depth += 1
+            i = next_start + len(start)
+        else:
+            depth -= 1
+            i = next_end + len(end)
+            if depth == 0:
+                kept_from = i
+
+    if depth == 0:
+        parts.append(text[kept_from:])
+
+    return ''.join(parts)
+
+# Replaces [[target|label]] and [[target]] links with their text and drops
+# file and category links, whose captions may hold links of their own
+def replace_links(text):
+    parts = []
+    i = 0
+
+    while True:
+        start = text.find('[[', i)
+        if start == -1:
+            break
+
+        end = matching_link_end(text, start)
+        if end == -1:
+            break
+
+        parts.append(text[i:start])
+
+        inner = text[start + 2:end]
+        if not inner.lstrip().lower().startswith(hidden_link_prefixes):
+            parts.append(replace_links(inner.rpartition('|')[2] if '|' in inner else inner))
+
+        i = end + 2
+
+    parts.append(text[i:])
+    return ''.join(parts)
+
+# Returns the index of the ']]' closing the link that starts at 'start', or
+# -1 if it isn't closed
+def matching_link_end(text, start):
+    depth = 0
+    i = start
+
+    while True:
+        next_start = text.find('[[', i)
+        next_end = text.find(']]', i)
+
+        if next_end == -1:
+            return -1
+
+        if next_start != -1 and next_start < next_end:
+            depth += 1
+            i = next_start + 2
+        else:
+            depth -= 1
+            if depth == 0:
+                return next_end
+            i = next_end + 2
+
+# Inserts the people rows yielded by 'results' into the reference count
+# index and, if they meet the threshold, into the people table.  The index
+# entries for each year found replace any it had before.
+def load_people(results):
+    years = set()
+    people = 0
+    inserted = 0
+
+    with db_wrapper.DBManager() as cur, metrics.timer('stage_seconds', stage='dump'):
+        batch = []
+
+        for rows in results:
+            for row in rows:
+                batch.append(row)
+
+                if len(batch) >= cfg.dump_insert_batch_size:
+                    inserted += insert_rows(cur, batch, years)
+                    people += len(batch)
+                    batch = []
+
+        inserted += insert_rows(cur, batch, years)
+        people += len(batch)
+
+        rebuild_histograms(cur, years)
+        metrics.increment('rows', people, stage='dump')
+
+    print(f'Found {people} people born in {len(years)} different years, inserted {inserted} into the DB')
+    print(f'Database now contains {db_wrapper.get_people_count()} people')
+
+# Inserts one batch of people rows in one transaction.  Returns the number
+# of rows added to the people table.
+def insert_rows(cur, batch, years):
+    for year in {row[3] for row in batch} - years:
+        cur.execute("delete from ref_count_index where year = ?", (year,))
+        years.add(year)
+
+    cur.executemany("insert into ref_count_index values (?, ?, ?, 0)",
+                    ((ref_count, year, title) for title, _, _, year, ref_count, _ in batch))
+
+    query = '''
+        insert or ignore into people (title, birth_year, reference_count, summary, image_fname,
+                                      summary_status, summary_attempts, pageid, lastrevid)
+        values (?, ?, ?, ?, NULL, 'ok', 1, ?, ?)
+        '''
+    cur.executemany(query, ((title, year, ref_count, summary, pageid, revid)
+                            for title, pageid, revid, year, ref_count, summary in batch
+                            if summary is not None))
+    inserted = cur.rowcount
+    db_wrapper.commit(cur)
+
+    return max(inserted, 0)
+
+def rebuild_histograms(cur, years):
+    for year in years:
+        ref_count_index.rebuild_histogram(cur, year)
@@ -0,0 +1,147 @@
+# A persistent cache of Wikipedia responses, shared by every fetch stage.
+#
+# Responses are stored in a single sqlite file under the output directory,
+# keyed by a hash of the request kind (e.g. 'page_info' or 'html') and the
+# page title.  Entries older than http_cache_ttl_days are treated as misses,
+# and once the cache grows past http_cache_max_mb the least recently used
+# entries are evicted.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import metrics
+from config import cfg
+
+lock = threading.Lock()
+conn = None
+total_size = 0
+
+def connect():
+    global conn, total_size
+
+    if conn is None:
+        conn = sqlite3.connect(f'{cfg.output_directory}/http_cache.db',
+                               timeout=cfg.db_busy_timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                title TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_title ON responses(title)')
+        total_size = conn.execute('select coalesce(sum(size), 0) from responses').fetchone()[0]
+
+    return conn
+
+def make_key(kind, title):
+    return hashlib.sha256(f'{kind}\0{title}'.encode('utf-8')).hexdigest()
+
+# Returns a dict of title -> cached value for the titles that are cached
+# and not expired.
+def get_many(kind, titles):
+    if not cfg.http_cache_enabled:
+        return {}
+
+    found = {}
+    now = time.time()
+    oldest = now - cfg.http_cache_ttl_days * 24 * 60 * 60
+
+    with lock:
+        db = connect()
+        for title in titles:
+            key = make_key(kind, title)
+            row = db.execute('select value from responses where key = ? and stored_at >= ?',
+                             (key, oldest)).fetchone()
+            if row:
+                db.execute('update responses set accessed_at = ? where key = ?', (now, key))
+                found[title] = json.loads(row[0])
+        db.commit()
+
+    metrics.increment('http_cache_hits', len(found), kind=kind)
+    metrics.increment('http_cache_misses', len(titles) - len(found), kind=kind)
+    return found
+
+# 'values' is a dict of title -> any json serializable value
+def put_many(kind, values):
+    global total_size
+
+    if not cfg.http_cache_enabled or not values:
+        return
+
+    now = time.time()
+
+    with lock:
+        db = connect()
+        for title, value in values.items():
+            key = make_key(kind, title)
+            text = json.dumps(value)
+            size = len(text)
+
+            row = db.execute('select size from responses where key = ?', (key,)).fetchone()
+            if row:
+                total_size -= row[0]
+
+            db.execute('insert or replace into responses values (?, ?, ?, ?, ?, ?, ?)',
+                       (key, kind, title, text, size, now, now))
+            total_size += size
+
+        evict(db)
+        db.commit()
+
+def get(kind, title):
+    return get_many(kind, [title]).get(title)
+
+def put(kind, title, value):
+    put_many(kind, {title: value})
+
+# Deletes every kind of cached response for 'titles', e.g. because their
+# pages have changed
+def invalidate(titles):
+    global total_size
+
+    if not cfg.http_cache_enabled or not titles:
+        return
+
+    with lock:
+        db = connect()
+        for title in titles:
+            size = db.execute('select coalesce(sum(size), 0) from responses where title = ?',
+                              (title,)).fetchone()[0]
+            db.execute('delete from responses where title = ?', (title,))
+            total_size -= size
+        db.commit()
+
+# Deletes the least recently used entries until the cache is back under
+# 90% of its size cap.  Must be called with the lock held.
+def evict(db):
+    global total_size
+
+    max_size = cfg.http_cache_max_mb * 1024 * 1024
+    if total_size <= max_size:
+        return
+
+    while total_size > max_size * 0.9:
+        db.execute('''
+            delete from responses where key in
+            (select key from responses order by accessed_at limit 1000)
+            ''')
+        total_size = db.execute('select coalesce(sum(size), 0) from responses').fetchone()[0]
+
+# Prints the hits and misses of this run, including those of --summary's
+# year workers, whose metrics are merged into this process's
+def print_stats():
+    hits = metrics.counter_values('http_cache_hits', 'kind')
+    misses = metrics.counter_values('http_cache_misses', 'kind')
+
+    for kind in sorted(set(hits) | set(misses)):
+        print(f'HTTP cache {kind}: {hits.get(kind, 0)} hits, {misses.get(kind, 0)} misses')
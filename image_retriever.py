@@ -1,105 +1,267 @@
-# Functionality to retrieve the "infobox" image from a person's Wikipedia page.  
+# Functionality to retrieve the "infobox" image from a person's Wikipedia page.
+#
+# Images are fetched in a pipeline: a pool of threads finds the image url
+# for each person while a separate pool of download workers streams the
+# images to disk over a shared keep-alive session.  The results are written
+# to the DB in batches.
+#
+# Images are downloaded as thumbnails no larger than image_max_dimension.
+# With image_storage set to 'blob' they are kept in the compact image_store
+# instead of as loose files under images/.
 
 import db_wrapper
-import sys
-import wikipedia
+import image_store
+import metrics
+import rate_limiter
+import title_aliases
+import wiki_api
 import re
 import os.path
+import logging
 import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 
-from config import cfg 
+from config import cfg
+
+log = logging.getLogger(__name__)
 
 img_suffix_pattern = re.compile('.+\.(\w+)$')
 supported_img_suffixes = ('jpg', 'JPG', 'png', 'PNG', 'jpeg', 'JPEG')
 
-def get_images():
+# Wikimedia thumbnail urls end in /<width>px-<file name>
+thumb_width_pattern = re.compile('/(\d+)px-[^/]+$')
+
+session = requests.Session()
+session.headers.update(
+    {
+        'User-Agent': f'WikiPeopleGetterTestBot/0.1 ({cfg.email})'
+    }
+)
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=cfg.image_download_workers))
+
+download_gate = rate_limiter.RequestGate(cfg.image_downloads_per_second,
+                                         cfg.image_download_workers,
+                                         cfg.image_download_workers)
+
+# The outcome of getting one person's image.  status is 'ok', 'none' if
+# they have no usable image, or 'error' if it should be retried.  img_str
+# is stored in people.image_fname: the image file, the reason there is no
+# image, or the url that failed.  image is (suffix, data) for images to be
+# put in the image store.  error is the class of the error.
+ImageResult = namedtuple('ImageResult', ['title', 'status', 'img_str', 'image', 'error'])
+
+# Gets the images of everyone who doesn't have one yet, or with
+# retry_failed, of everyone whose image failed fewer than
+# max_fetch_attempts times, or with refresh, of everyone whose image is
+# stale because their page changed.
+def get_images(retry_failed=False, refresh=False):
     print(f"Getting images")
 
-    q = "select title from people where image_fname is null"
+    if retry_failed:
+        q = "select title from people where image_status = 'error' and image_attempts < ?"
+        params = (cfg.max_fetch_attempts,)
+    elif refresh:
+        q = "select title from people where image_status = 'stale'"
+        params = ()
+    else:
+        q = "select title from people where image_fname is null"
+        params = ()
 
     with db_wrapper.DBManager() as cur:
-        cur_for_update = cur.connection.cursor()
-
-        for row in cur.execute(q):
-            title = row[0]
-            print(f'Attempting to get image for {title}')
-            sys.stdout.flush()
-            get_image(title, cur_for_update)
-            cur.connection.commit()
-            sys.stdout.flush()
+        titles = [row[0] for row in cur.execute(q, params)]
+
+    batch_size = wiki_api.MAX_TITLES_PER_REQUEST
+    downloads = set()
+    results = []
+
+    with ThreadPoolExecutor(max_workers=cfg.max_concurrent_requests) as resolvers, \
+         ThreadPoolExecutor(max_workers=cfg.image_download_workers) as downloaders, \
+         db_wrapper.DBManager() as cur, \
+         metrics.timer('stage_seconds', stage='images'):
+
+        for start in range(0, len(titles), batch_size):
+            batch = titles[start:start + batch_size]
+            lead_image_urls = get_lead_image_urls(batch)
+
+            # Fetch pages by their canonical titles, so that people stored
+            # under a title that redirects still get an image
+            canonical = title_aliases.canonical_titles(batch)
+            resolved = resolvers.map(partial(get_image_url, redownload=refresh), batch,
+                                     [lead_image_urls.get(title) for title in batch],
+                                     [canonical[title] for title in batch])
+
+            for title, (url, result) in zip(batch, resolved):
+                if url is None:
+                    results.append(result)
+                else:
+                    downloads.add(downloaders.submit(download_image, title, url))
+
+            # Don't let the downloads fall too far behind the url lookups
+            while len(downloads) > cfg.image_download_workers * 4:
+                done, downloads = wait(downloads, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+
+            if len(results) >= cfg.image_db_batch_size:
+                save_results(results, cur)
+                results = []
+
+        for future in wait(downloads).done:
+            results.append(future.result())
+        save_results(results, cur)
 
     print("Finished getting images")
 
-def get_image(title, cur):
-    image_fname = image_already_downloaded(title)
+# When image_url_source is 'pageimages', returns a dict of title -> lead
+# image url fetched in one batch.  Otherwise the url is found in each
+# page's infobox by get_image_url and this returns an empty dict.
+def get_lead_image_urls(titles):
+    if cfg.image_url_source != 'pageimages':
+        return {}
+
+    try:
+        infos = wiki_api.get_page_infos(titles)
+    except (requests.RequestException, wiki_api.ApiError) as e:
+        log.warning(f'Failed to get lead images for {len(titles)} titles due to {e!r}')
+        return {}
+
+    return {title: info.image_url for title, info in infos.items()}
+
+# Returns (url, None) if there is an image to download for 'title', or
+# (None, ImageResult) if there isn't, because we already have it or there
+# is no usable image.  The page is fetched as 'page_title' if given.  With
+# redownload, an image we already have is replaced.
+# Runs on a worker thread.
+def get_image_url(title, lead_image_url=None, page_title=None, redownload=False):
+    log.debug(f'Attempting to get image for {title}')
+
+    image_fname = None if redownload else image_already_downloaded(title)
     if image_fname:
-        print(f"Skipping fetch of img for title {title} because we already have it")
-        update_img_in_db(title, image_fname, cur)
-        return None
+        log.debug(f"Skipping fetch of img for title {title} because we already have it")
+        return None, ImageResult(title, 'ok', image_fname, None, None)
+
+    if cfg.image_url_source == 'pageimages':
+        if lead_image_url is None:
+            log.debug("No lead image")
+            return None, ImageResult(title, 'none', "no image available", None, None)
+        url = lead_image_url
+    else:
+        url, result = get_infobox_image_url(page_title or title)
+        if url is None:
+            return None, result._replace(title=title)
 
-    html = get_html(title)
+    match = img_suffix_pattern.match(url)
+    if not match:
+        log.warning(f'url does not match regex {url}')
+        return None, ImageResult(title, 'none', "bad url", None, None)
+
+    suffix = match.group(1)
+
+    if suffix not in supported_img_suffixes:
+        log.warning(f'Unhandled suffix: {suffix}')
+        return None, ImageResult(title, 'none', f'bad suffix: {suffix}', None, None)
+
+    url = to_thumbnail_url(url.replace(' src="', 'https:', 1))
+    log.debug(f'url for {title} is {url}')
+
+    return url, None
+
+# Returns (' src="//upload...' fragment of the first image in the page's
+# infobox, None), or (None, ImageResult) if there isn't one or the page
+# couldn't be fetched.
+def get_infobox_image_url(title):
+    try:
+        html = get_html(title)
+    except (requests.RequestException, wiki_api.ApiError, KeyError) as e:
+        log.warning(f'Skipping title ${title} due to {e!r}')
+        return None, ImageResult(title, 'error', "failed to get page", None, type(e).__name__)
 
     infobox_start = html.find("infobox")
     if infobox_start == -1:
-        print("Didn't find an infobox")
-        update_img_in_db(title, "no infobox", cur)
-        return None
+        log.debug("Didn't find an infobox")
+        return None, ImageResult(title, 'none', "no infobox", None, None)
 
     index_start = html.find(' src="//upload.wikimedia.org/wikipedia/',
                             infobox_start, infobox_start + 5000)
     if index_start == -1:
-        print("Didn't find the start")
-        update_img_in_db(title, "no image available", cur)        
-        return None
+        log.debug("Didn't find the start")
+        return None, ImageResult(title, 'none', "no image available", None, None)
 
     index_end = html.find('" ', index_start, index_start + 1000)
 
     if index_end == -1:
-        print("Didn't find the end")
-        update_img_in_db(title, "bad end: " + html[index_start:index_start+1000], cur)
-        return None
+        log.debug("Didn't find the end")
+        bad_end = "bad end: " + html[index_start:index_start+1000]
+        return None, ImageResult(title, 'none', bad_end, None, None)
 
-    url = html[index_start:index_end]
+    return html[index_start:index_end], None
 
-    match = img_suffix_pattern.match(url)
-    if not match:
-        print(f'url does not match regex {url}')
-        update_img_in_db(title, "bad url", cur)
-        return None
+# Returns enough of the page's HTML to find the infobox image in.  How much
+# of the page is downloaded depends on image_html_source: the lead section
+# ('section0'), the rendered page up to the end of the infobox search
+# window ('stream'), or the whole page ('full').  A page that doesn't exist
+# has no HTML; other errors are raised.
+def get_html(title):
+    html=""
 
-    suffix = match.group(1)
+    try:
+        if cfg.image_html_source == 'stream':
+            html = get_streamed_html(title)
+        elif cfg.image_html_source == 'section0':
+            html = wiki_api.get_html(title, section=0)
+        else:
+            html = wiki_api.get_html(title)
+    except wiki_api.ApiError as e:
+        if e.code != 'missingtitle':
+            raise
+        log.debug(f'Skipping title ${title} because of PageError')
 
-    if suffix not in supported_img_suffixes:
-        print(f'Unhandled suffix: {suffix}')
-        update_img_in_db(title, f'bad suffix: {suffix}', cur)
-        return None
-    
-    url = url.replace(' src="', 'https:', 1)
-    print(f'url for {title} is {url}')
+    return html
 
-    get_image_from_url(title, cur, url)
+# Infobox images are usually thumbnails already; ask for a smaller one
+# if it is bigger than image_max_dimension.
+def to_thumbnail_url(url):
+    match = thumb_width_pattern.search(url)
+    if match and int(match.group(1)) > cfg.image_max_dimension:
+        url = url[:match.start(1)] + str(cfg.image_max_dimension) + url[match.end(1):]
 
-def get_html(title):
-    html=""
+    return url
 
-    try:
-        page = wikipedia.page(title, pageid=None, auto_suggest=False,
-                              redirect=False, preload=False)
-        html = page.html()
-    except wikipedia.exceptions.RedirectError:
-        print(f'Skipping title ${title} because it will redirect')
-    except wikipedia.exceptions.PageError:
-        print(f'Skipping title ${title} because of PageError')
-    except KeyError:
-        print("Skipping due to KeyError")
+# Reads the rendered page a chunk at a time and stops as soon as it has
+# the part get_infobox_image_url searches.
+def get_streamed_html(title):
+    html = ""
+    infobox_start = -1
+    params = {'action': 'render', 'title': title}
+
+    with wiki_api.stream_with_retries(wiki_api.session, cfg.index_url,
+                                      params=params) as response:
+        if response.status_code == 404:
+            log.debug(f'Skipping title ${title} because of PageError')
+            return html
+
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+
+        for chunk in response.iter_content(chunk_size=16 * 1024, decode_unicode=True):
+            html += chunk
+
+            if infobox_start == -1:
+                infobox_start = html.find("infobox")
+            if infobox_start != -1 and len(html) >= infobox_start + 6000:
+                break
 
     return html
 
 def image_already_downloaded(title):
+    if cfg.image_storage == 'blob':
+        return image_store.find(title)
+
     cleaned_title = get_cleaned_title(title)
     for suffix in supported_img_suffixes:
         fname = f'{cfg.output_directory}/images/{cleaned_title}.{suffix}'
-        if os.path.exists(fname):    
+        if os.path.exists(fname):
             return fname
 
     return None
@@ -109,47 +271,100 @@ def get_cleaned_title(title):
     cleaned_title = cleaned_title.replace('"', '')
     return cleaned_title
 
-def update_img_in_db(title, img_str, cur):
-    cur.execute("update people set image_fname = ? where title = ?", (img_str, title))
+# 'results' is a list of ImageResult.  Images held in memory are added to
+# the image store and every result is written to the people table in one
+# transaction.
+def save_results(results, cur):
+    images = [(result.title, *result.image) for result in results if result.image]
+    locations = image_store.put_many(images) if images else {}
+
+    query = '''
+        update people
+        set image_fname = ?, image_status = ?, image_error = ?,
+            image_attempts = image_attempts + 1
+        where title = ?
+        '''
+    updates = [(locations.get(result.title, result.img_str), result.status, result.error,
+                result.title) for result in results]
+    cur.executemany(query, updates)
+    db_wrapper.commit(cur)
+
+    for result in results:
+        metrics.increment('images', status=result.status)
+    metrics.increment('rows', len(results), stage='images')
+
+# Downloads the image at 'url'.  Returns an ImageResult whose img_str is
+# the image's filename, or the url if the download failed.  With
+# image_storage set to 'blob', the image is returned in memory as
+# (suffix, data) for save_results to store instead.
+# Runs on a download worker thread.
+def download_image(title, url):
+    suffix = img_suffix_pattern.match(url).group(1)
 
-def get_image_from_url(title, cur, url):
+    try:
+        with wiki_api.stream_with_retries(session, url, download_gate) as response:
+            if response.status_code != 200:
+                log.debug(response.request.headers)
+                code = response.status_code
+                if code != 403:
+                    text = response.text
+                else:
+                    text = "Unauthorized"
+
+                log.warning(f'ERROR status = {code}, text = {text}')
+                return ImageResult(title, 'error', url, None, f'HTTP {code}')
+
+            if cfg.image_storage == 'blob':
+                log.debug("SUCCESS")
+                return ImageResult(title, 'ok', None, (suffix, response.content), None)
+
+            image_fname = write_image_file(title, suffix, response)
+    except requests.RequestException as e:
+        log.warning(f'ERROR downloading {url}: {e!r}')
+        return ImageResult(title, 'error', url, None, type(e).__name__)
+
+    log.debug("SUCCESS")
+    return ImageResult(title, 'ok', image_fname, None, None)
+
+# Streams the body of 'response' to images/<title>.<suffix>
+def write_image_file(title, suffix, response):
     cleaned_title = get_cleaned_title(title)
 
-    match = img_suffix_pattern.match(url)
-    if not match:
-        print(f'url does not match regex {url}')
-        return None
-    else:
-        suffix = match.group(1)
-
-    # Get a copy of the default headers that requests would use
-    headers = requests.utils.default_headers()
-
-    headers.update(
-        {
-            'User-Agent': f'WikiPeopleGetterTestBot/0.1 ({cfg.email})'
-        }
-    )
-
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(response.request.headers)
-        code = response.status_code
-        if code != 403:
-            text = response.text
-        else:
-            text = "Unauthorized"
+    image_fname = f'{cfg.output_directory}/images/{cleaned_title}.{suffix}'
+    os.makedirs(os.path.dirname(image_fname), exist_ok=True)
 
-        print(f'ERROR status = {code}, text = {text}')
-        update_img_in_db(title, url, cur)
-        return None
+    # Write to a temporary file so an interrupted download never leaves a
+    # partial image that looks complete
+    tmp_fname = image_fname + '.part'
+    with open(tmp_fname, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+    os.replace(tmp_fname, image_fname)
 
-    print("SUCCESS")
+    return image_fname
 
-    image_fname = f'{cfg.output_directory}/images/{cleaned_title}.{suffix}'
-    os.makedirs(os.path.dirname(image_fname), exist_ok=True)
+# Writes each person's image kept in the image store (image_storage
+# 'blob') to 'directory' as <title>.<suffix>, the names image_storage
+# 'files' would have given them
+def export_images(directory):
+    prefix = image_store.store_fname() + '#'
+
+    with db_wrapper.DBManager() as cur:
+        rows = cur.execute("select title, image_fname from people where image_fname is not null")
+        locations = [(title, fname) for title, fname in rows if fname.startswith(prefix)]
+
+    os.makedirs(directory, exist_ok=True)
+    exported = 0
+
+    for title, location in locations:
+        image = image_store.read(location)
+        if image is None:
+            log.warning(f'The image of {title} is missing from {image_store.store_fname()}')
+            continue
 
-    with open(image_fname, 'wb') as f:
-        f.write(response.content)
+        suffix, data = image
+        with open(os.path.join(directory, f'{get_cleaned_title(title)}.{suffix}'), 'wb') as f:
+            f.write(data)
+        exported += 1
 
-    update_img_in_db(title, image_fname, cur)
+    print(f'Exported {exported} images to {directory}')
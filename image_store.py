@@ -0,0 +1,69 @@
+# A compact store for people's images.
+#
+# Instead of one loose file per person under images/, every image is kept
+# as a BLOB in a single sqlite file next to people.db.  people.image_fname
+# records an image's location as '<store filename>#<id>'.
+
+import sqlite3
+import threading
+
+from config import cfg
+
+lock = threading.Lock()
+conn = None
+
+def store_fname():
+    return f'{cfg.output_directory}/images.db'
+
+def connect():
+    global conn
+
+    if conn is None:
+        conn = sqlite3.connect(store_fname(), timeout=cfg.db_busy_timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY,
+                title TEXT UNIQUE NOT NULL,
+                suffix TEXT NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+
+    return conn
+
+def to_location(image_id):
+    return f'{store_fname()}#{image_id}'
+
+# Returns the location of the image stored for 'title', or None
+def find(title):
+    with lock:
+        row = connect().execute('select id from images where title = ?', (title,)).fetchone()
+
+    return to_location(row[0]) if row else None
+
+# 'images' is a list of (title, suffix, data).  Stores them in one
+# transaction and returns a dict of title -> location.
+def put_many(images):
+    locations = {}
+
+    with lock:
+        db = connect()
+        for title, suffix, data in images:
+            db.execute('insert or replace into images (title, suffix, data) values (?, ?, ?)',
+                       (title, suffix, data))
+            image_id = db.execute('select id from images where title = ?', (title,)).fetchone()[0]
+            locations[title] = to_location(image_id)
+        db.commit()
+
+    return locations
+
+# Returns (suffix, data) for a location returned by find or put_many
+def read(location):
+    image_id = int(location.rsplit('#', 1)[1])
+
+    with lock:
+        row = connect().execute('select suffix, data from images where id = ?', (image_id,)).fetchone()
+
+    return row
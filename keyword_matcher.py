@@ -0,0 +1,71 @@
+# Finds every keyword that occurs in a piece of text in a single pass,
+# using the Aho-Corasick algorithm.
+#
+# Matching behaves like sqlite's "text like '%keyword%'": a keyword matches
+# anywhere in the text, including inside a longer word, and only ASCII
+# letters are compared case-insensitively.  Unlike LIKE, '%' and '_' in a
+# keyword are matched literally.
+
+import string
+
+ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+class KeywordMatcher():
+    # 'keywords' is an iterable of (keyword, value) pairs.  match() returns
+    # the set of values whose keyword occurs in the text.
+    def __init__(self, keywords):
+        # State 0 is the root.  For each state: outgoing edges, failure
+        # link, and the values of all keywords that end there.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+        self.always = set()
+
+        for keyword, value in keywords:
+            keyword = keyword.translate(ascii_lower)
+            if not keyword:
+                self.always.add(value)
+                continue
+
+            state = 0
+            for ch in keyword:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.out[state].add(value)
+
+        self.build_failure_links()
+
+    def build_failure_links(self):
+        queue = list(self.goto[0].values())
+
+        for state in queue:
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+
+                # A keyword that is a suffix of another ends in the same place
+                self.out[child] |= self.out[self.fail[child]]
+
+    def match(self, text):
+        found = set(self.always)
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        state = 0
+        for ch in text.translate(ascii_lower):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+
+        return found
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import wikipediaapi
-import wikipedia
 import sys
 import argparse
 import db_wrapper
@@ -9,7 +7,15 @@ import wiki_by_birth_year
 import wiki_summary
 import professions
 import image_retriever
+import scheduler
+import http_cache
+import ref_count_index
+import dump_ingest
+import metrics
+import cProfile
+import logging
 import os
+import pstats
 import re
 from config import cfg 
 
@@ -17,18 +23,82 @@ sys.stdin.reconfigure(encoding='utf-8')
 sys.stdout.reconfigure(encoding='utf-8')
 
 def do_year_range(year_start, year_end):
-    for year in range(year_start, year_end + 1):
-        print(f'\n====== Working on year {year} ======')
-        wiki_by_birth_year.write_birth_year_file(year)
-        wiki_summary.insert_summaries_for_year(year)
+    scheduler.run_years(year_start, year_end)
 
     print('')
-    professions.apply_keyword_to_professions()
+    professions.update_professions()
+
+def do_retry_failed():
+    wiki_summary.retry_failed_summaries()
+    image_retriever.get_images(retry_failed=True)
+
+    print('')
+    professions.update_professions()
+
+def do_ingest_dump(dump_fname):
+    dump_ingest.ingest_dump(dump_fname, args.dump_index, args.categorylinks)
+
+    print('')
+    professions.update_professions()
+
+def do_refresh():
+    wiki_summary.refresh_people()
+    image_retriever.get_images(refresh=True)
+
+    print('')
+    professions.update_professions()
 
 def do_backfill(fname):
     print("Backfill")
     wiki_summary.insert_summaries_for_file(fname)
 
+def run_command():
+    if args.summary:
+        do_year_range(*args.summary)
+    elif args.assign_professions:
+        professions.update_professions()
+    elif args.filter_professions:
+        professions.do_filter(dry_run=args.dry_run)
+    elif args.images:
+        image_retriever.get_images()
+    elif args.export_images:
+        image_retriever.export_images(args.export_images)
+    elif args.retry_failed:
+        do_retry_failed()
+    elif args.refresh:
+        do_refresh()
+    elif args.profession_counts:
+        professions.print_profession_summary()
+    elif args.details:
+        wiki_summary.print_details(args.details)
+    elif args.profession_members:
+        professions.print_profession_members(args.profession_members)
+    elif args.backfill:
+        do_backfill(args.backfill)
+    elif args.convert_birth_year_files:
+        wiki_by_birth_year.convert_birth_year_files()
+    elif args.index_birth_year_files:
+        wiki_by_birth_year.index_birth_year_files()
+    elif args.ingest_dump:
+        do_ingest_dump(args.ingest_dump)
+    elif args.search:
+        professions.print_search_results(args.search)
+    elif args.vacuum:
+        db_wrapper.vacuum()
+    elif args.ref_count_histogram is not None:
+        ref_count_index.print_counts(args.ref_count_histogram, by=args.by)
+
+# Runs 'command' under cProfile and writes the profile to the output
+# directory.  Only this process is profiled, not --summary's year workers.
+def run_profiled(command):
+    profiler = cProfile.Profile()
+    profiler.runcall(command)
+
+    fname = os.path.join(cfg.output_directory, 'profile.prof')
+    profiler.dump_stats(fname)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    print(f'Profile written to {fname}; explore it with: python -m pstats {fname}')
+
 def validate_summary_arg(value):
     value = value.lstrip()
     result = re.match('^(-?\d+):(-?\d+)$', value)
@@ -73,6 +143,21 @@ group.add_argument("-i", "--images",
                     action="store_true",
                     help="Fetch images for all people in the DB whose image is not already downloaded")
 
+group.add_argument("--export-images",
+                    metavar="DIRECTORY",
+                    required=False,
+                    help="With image_storage: blob, write everyone's image to DIRECTORY as <title>.<suffix>")
+
+group.add_argument("--retry-failed",
+                    required=False,
+                    action="store_true",
+                    help="Fetch the summaries and images that failed before again, following redirects and merging people who turn out to be the same page")
+
+group.add_argument("--refresh",
+                    required=False,
+                    action="store_true",
+                    help="Fetch the summaries, reference counts and images of the people whose Wikipedia pages changed since they were fetched")
+
 group.add_argument("-a", "--assign-professions",
                     required=False,
                     action="store_true",
@@ -98,24 +183,91 @@ group.add_argument("-d", "--details",
                     required=False,
                     help="Print the details available for PERSON")
               
+parser.add_argument("--dry-run",
+                    required=False,
+                    action="store_true",
+                    help="With --filter-professions, report how many people would be removed per profession without removing them")
+
+group.add_argument("--convert-birth-year-files",
+                    required=False,
+                    action="store_true",
+                    help="Write a compact binary copy of each birth year file, which loads faster")
+
+group.add_argument("--index-birth-year-files",
+                    required=False,
+                    action="store_true",
+                    help="Add all birth year files to the reference count index used by --ref-count-histogram")
+
+group.add_argument("--ref-count-histogram",
+                    metavar="N",
+                    required=False,
+                    type=int,
+                    help="Show how many crawled people have at least N references, per decade")
+
+parser.add_argument("--stream",
+                    required=False,
+                    action="store_true",
+                    help="With --summary, fetch summaries and assign professions while each year is still being crawled")
+
+parser.add_argument("--by",
+                    required=False,
+                    choices=("year", "decade"),
+                    default="decade",
+                    help="With --ref-count-histogram, count per year or per decade")
+
+group.add_argument("--ingest-dump",
+                    metavar="PAGES_ARTICLES_XML_BZ2",
+                    required=False,
+                    help="Build the database from a local pages-articles XML dump instead of the live API")
+
+parser.add_argument("--dump-index",
+                    metavar="INDEX_TXT_BZ2",
+                    required=False,
+                    help="With --ingest-dump of a multistream dump, its index file, to parse the dump in parallel")
+
+parser.add_argument("--categorylinks",
+                    metavar="CATEGORYLINKS_SQL_GZ",
+                    required=False,
+                    help="With --ingest-dump, a categorylinks SQL dump to read birth year categories from")
+
+group.add_argument("--vacuum",
+                    required=False,
+                    action="store_true",
+                    help="Compact people.db and rebuild its full-text index")
+
+group.add_argument("--search",
+                    metavar="QUERY",
+                    required=False,
+                    help="Full-text search of people's titles and summaries, best matches of the most referenced people first")
+
+parser.add_argument("-v", "--verbose",
+                    required=False,
+                    action="store_true",
+                    help="Log what happens to each person, not just the progress of each stage")
+
+parser.add_argument("--profile",
+                    required=False,
+                    action="store_true",
+                    help="Run the command under cProfile, print the slowest functions and save the profile to the output directory")
+
 args = parser.parse_args()
 
+logging.basicConfig(level=logging.DEBUG if args.verbose else cfg.log_level,
+                    format='%(message)s', stream=sys.stdout)
+# Not interested in each connection requests makes
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
 os.makedirs(cfg.output_directory, exist_ok=True)
+db_wrapper.initialize_tables()
+wiki_by_birth_year.repair_bc_birth_years()
+
+if args.stream:
+    cfg.streaming_pipeline = True
 
-if args.summary:
-    do_year_range(*args.summary)
-elif args.assign_professions:
-    professions.apply_keyword_to_professions()
-elif args.filter_professions:
-    professions.do_filter()
-elif args.images:
-    image_retriever.get_images()
-elif args.profession_counts:
-    professions.print_profession_summary()
-elif args.details:
-    wiki_summary.print_details(args.details)
-elif args.profession_members:
-    professions.print_profession_members(args.profession_members)
-elif args.backfill:
-    do_backfill(args.backfill)
+if args.profile:
+    run_profiled(run_command)
+else:
+    run_command()
 
+http_cache.print_stats()
+metrics.write_reports(' '.join(arg.strip() for arg in sys.argv[1:]))
@@ -0,0 +1,220 @@
+# Counters and latency histograms for the current run.
+#
+# Modules record what they do as they do it: HTTP requests by endpoint,
+# sqlite commits, cache hits and misses, and the time taken and rows
+# written by each stage (crawl, summaries, images, professions).  At the
+# end of the run main.py writes everything to run_report_file as JSON and,
+# if prometheus_textfile is set, in the Prometheus text format for
+# node_exporter's textfile collector.
+#
+# Each metric has a name and optional labels, e.g.
+#   metrics.increment('rows', 50, stage='summaries')
+#   with metrics.timer('http_request_seconds', endpoint='query'): ...
+#
+# Worker processes record into their own copy; scheduler.py sends each
+# year job's metrics back to the parent with collect() and merge().
+
+import json
+import os.path
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from config import cfg
+
+# Upper bounds, in seconds, of the latency histogram buckets.  Anything
+# slower falls in a final +Inf bucket.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+lock = threading.Lock()
+started_at = time.time()
+
+# (name, labels) -> value, where labels is a sorted tuple of (key, value)
+counters = Counter()
+# (name, labels) -> [count, sum, max, bucket counts...]
+histograms = {}
+
+def key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def increment(name, amount=1, **labels):
+    with lock:
+        counters[key(name, labels)] += amount
+
+# Returns a dict of the value of 'label' -> count, for the counter 'name'
+def counter_values(name, label):
+    values = Counter()
+
+    with lock:
+        for (n, labels), value in counters.items():
+            if n == name:
+                values[dict(labels).get(label)] += value
+
+    return dict(values)
+
+# Records one latency, in seconds
+def observe(name, seconds, **labels):
+    k = key(name, labels)
+
+    with lock:
+        histogram = histograms.get(k)
+        if histogram is None:
+            histogram = histograms[k] = [0, 0.0, 0.0] + [0] * (len(BUCKETS) + 1)
+
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[2] = max(histogram[2], seconds)
+        histogram[3 + bucket_index(seconds)] += 1
+
+def bucket_index(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+# Times the block and records it with observe()
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+# Returns everything recorded since the last collect() and starts over.
+# The result can be pickled and passed to merge() in another process.
+def collect():
+    with lock:
+        snapshot = (dict(counters), {k: list(v) for k, v in histograms.items()})
+        counters.clear()
+        histograms.clear()
+
+    return snapshot
+
+def merge(snapshot):
+    more_counters, more_histograms = snapshot
+
+    with lock:
+        counters.update(more_counters)
+
+        for k, more in more_histograms.items():
+            histogram = histograms.get(k)
+            if histogram is None:
+                histograms[k] = list(more)
+                continue
+
+            histogram[0] += more[0]
+            histogram[1] += more[1]
+            histogram[2] = max(histogram[2], more[2])
+            for i in range(3, len(histogram)):
+                histogram[i] += more[i]
+
+# Returns the smallest bucket bound below which a fraction 'q' of the
+# observations fall
+def quantile(histogram, q):
+    target = q * histogram[0]
+    seen = 0
+
+    for i, bound in enumerate(BUCKETS):
+        seen += histogram[3 + i]
+        if seen >= target:
+            return bound
+
+    return histogram[2]
+
+# Returns the run's metrics as a dict that can be written as JSON
+def report(command):
+    duration = time.time() - started_at
+
+    with lock:
+        counter_rows = [dict(name=name, labels=dict(labels), value=value)
+                        for (name, labels), value in sorted(counters.items())]
+        histogram_rows = [dict(name=name, labels=dict(labels), count=h[0], sum=h[1],
+                               mean=h[1] / h[0] if h[0] else 0, max=h[2],
+                               p50=quantile(h, 0.5), p95=quantile(h, 0.95), p99=quantile(h, 0.99))
+                          for (name, labels), h in sorted(histograms.items())]
+
+        # Rows per second of each stage, over the time spent in the stage
+        stages = {}
+        for (name, labels), h in histograms.items():
+            if name == 'stage_seconds':
+                stage = dict(labels)['stage']
+                rows = counters.get(key('rows', {'stage': stage}), 0)
+                stages[stage] = dict(seconds=h[1], rows=rows,
+                                     rows_per_second=rows / h[1] if h[1] else 0)
+
+        requests = sum(h[0] for (name, _), h in histograms.items()
+                       if name == 'http_request_seconds')
+
+    return dict(command=command,
+                started_at=started_at,
+                duration_seconds=duration,
+                http_requests_per_second=requests / duration if duration else 0,
+                stages=stages,
+                counters=counter_rows,
+                histograms=histogram_rows)
+
+# Writes run_report_file, and prometheus_textfile if it is set, into the
+# output directory
+def write_reports(command):
+    if cfg.run_report_file:
+        fname = os.path.join(cfg.output_directory, cfg.run_report_file)
+        write_atomically(fname, json.dumps(report(command), indent=2) + '\n')
+        print(f'Run report written to {fname}')
+
+    if cfg.prometheus_textfile:
+        write_atomically(cfg.prometheus_textfile, prometheus_text())
+
+# node_exporter may read the file at any time, so it must never see a
+# partly written one
+def write_atomically(fname, text):
+    with open(fname + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(fname + '.tmp', fname)
+
+# Returns the metrics in the Prometheus text exposition format, with every
+# name prefixed by wiki_people_
+def prometheus_text():
+    lines = []
+
+    with lock:
+        names = {}
+        for name, labels in counters:
+            names.setdefault(name, 'counter')
+        for name, labels in histograms:
+            names.setdefault(name, 'histogram')
+
+        for name, kind in sorted(names.items()):
+            full_name = f'wiki_people_{name}' + ('_total' if kind == 'counter' else '')
+            lines.append(f'# TYPE {full_name} {kind}')
+
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f'{full_name}{format_labels(labels)} {value}')
+                continue
+
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+
+                cumulative = 0
+                for i, bound in enumerate(BUCKETS + ('+Inf',)):
+                    cumulative += h[3 + i]
+                    le = format_labels(labels + (('le', str(bound)),))
+                    lines.append(f'{full_name}_bucket{le} {cumulative}')
+                lines.append(f'{full_name}_sum{format_labels(labels)} {h[1]}')
+                lines.append(f'{full_name}_count{format_labels(labels)} {h[0]}')
+
+        lines.append('# TYPE wiki_people_last_run_timestamp_seconds gauge')
+        lines.append(f'wiki_people_last_run_timestamp_seconds {started_at}')
+
+    return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
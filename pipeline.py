@@ -0,0 +1,96 @@
+# A fused version of a --summary year, used when streaming_pipeline is set.
+#
+# Normally a year's category is crawled into its birth year file, and only
+# then is the file read back to fetch summaries, with professions assigned
+# once the whole year range is done.  Here the stages are connected by a
+# queue instead:
+#
+#   crawl --> birth year file
+#         --> queue --> summaries --> insert --> assign professions
+#
+# The crawl puts each batch of members on the queue as soon as they are
+# written to the file.  A second thread fetches the summaries of those who
+# meet min_ref_count_for_summary, inserts them and tags their professions
+# straight away, so the crawl's requests and the summary requests overlap.
+# Whenever it has caught up with the crawl it inserts what it has; while it
+# is behind, it inserts up to summary_insert_batch_size people at a time.
+
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import db_wrapper
+import metrics
+import professions
+import wiki_by_birth_year
+import wiki_summary
+
+from config import cfg
+
+# Returns True if everyone in the year's category was summarized, and
+# False if the birth year file already existed or its crawl was resumed, in
+# which case the people crawled before still need to be.
+def crawl_and_summarize(year):
+    people = queue.Queue(maxsize=cfg.pipeline_queue_size)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        summarizer = executor.submit(summarize_stream, people, year)
+
+        try:
+            complete = wiki_by_birth_year.write_birth_year_file(
+                year, lambda members: put(people, members, summarizer))
+        finally:
+            # Let the summarizer finish the people it has been given
+            put(people, None, summarizer)
+
+        summarizer.result()
+
+    return complete
+
+# Puts 'item' on the queue, unless the summarizer has stopped, in which
+# case its error is raised
+def put(people, item, summarizer):
+    while not summarizer.done():
+        try:
+            people.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+    summarizer.result()
+
+# Takes batches of (title, ref_count, year) off the queue until it gets
+# None.  Runs on its own thread.
+def summarize_stream(people, year):
+    # If the keywords have changed, tagging is left to update_professions
+    keywords = professions.current_keywords()
+    batch = []
+
+    with db_wrapper.DBManager() as cur:
+        while True:
+            members = people.get()
+            if members is None:
+                break
+
+            batch.extend(person for person in members
+                         if person[1] >= cfg.min_ref_count_for_summary)
+
+            if batch and (people.empty() or len(batch) >= cfg.summary_insert_batch_size):
+                write_batch(cur, batch, year, keywords)
+                batch = []
+
+        write_batch(cur, batch, year, keywords)
+
+def write_batch(cur, batch, year, keywords):
+    if not batch:
+        return
+
+    with metrics.timer('stage_seconds', stage='summaries'):
+        inserted = wiki_summary.insert_batch(cur, batch)
+
+    if keywords is not None:
+        with metrics.timer('stage_seconds', stage='professions'):
+            tagged = professions.tag_untagged(cur, keywords, 'birth_year = ?', (year,))
+            db_wrapper.commit(cur)
+        metrics.increment('rows', tagged, stage='professions')
+
+    print(f'Inserted {inserted} people born in {year}')
@@ -3,7 +3,11 @@
 import sys
 import sqlite3
 import db_wrapper
+import keyword_matcher
+import metrics
 import csv
+import hashlib
+import time
 import yaml
 import os.path
 
@@ -11,78 +15,249 @@ from config import cfg
 
 csv_name='keyword_to_professions.csv'
 
+# Rebuilds the people_to_profession table from scratch
 def apply_keyword_to_professions():
     print("Starting update of people_to_profession table...")
     sys.stdout.flush() 
-    
-    with db_wrapper.DBManager() as cur, open(csv_name, newline='') as csvfile:
+
+    keywords, keywords_hash = load_keywords()
+
+    with db_wrapper.Transaction() as cur, metrics.timer('stage_seconds', stage='professions'):
         # start fresh
         cur.execute('DELETE FROM people_to_profession')
 
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            apply_keyword(cur, row['keyword'], row['profession'])
+        tag_people(cur, keywords, '1')
+
+        cur.execute("update people set tagged_at = ?", (time.time(),))
+        metrics.increment('rows', cur.rowcount, stage='professions')
+        record_keywords(cur, keywords, keywords_hash)
 
     print("people_to_profession table updated")
 
-def apply_keyword(cur, keyword, profession):
-    insert_cursor = cur.connection.cursor()
+# Brings the people_to_profession table up to date with the least work:
+# if keyword_to_professions.csv changed since the last run, only the
+# professions whose keywords were added or removed are re-matched, and
+# then people who have not been tagged yet (new or changed summaries)
+# are tagged with every keyword.
+def update_professions():
+    keywords, keywords_hash = load_keywords()
 
-    query = "select title from people where substr(summary, 0, 300) like ?"
-    #query = "select title from people where substr(summary, 0, 300) like '% " + keyword + "%'" 
-    for row in cur.execute(query, ['%'+keyword+'%']):
-        title = row[0]
-        insert_cursor.execute("insert or ignore into people_to_profession values (?, ?)",
-                              (title, profession))
+    with db_wrapper.DBManager() as cur:
+        previous_hash = db_wrapper.get_state(cur, 'keywords_hash')
 
-    insert_cursor.close()
+    if previous_hash is None:
+        # Nothing to be incremental from
+        apply_keyword_to_professions()
+        return
 
-def do_filter():
-    start_count = db_wrapper.get_people_count()
-    filter_professions(cfg.min_ref_counts_per_profession)
-    filter_professions(cfg.min_ref_counts_per_sole_profession, must_be_sole_profession=True)
-    # This table needs to be rebuilt to remove the now deleted people
-    apply_keyword_to_professions()
-    end_count = db_wrapper.get_people_count()
-    print(f'Removed {start_count - end_count} people')
+    print("Starting incremental update of people_to_profession table...")
+    sys.stdout.flush()
 
-def filter_professions(profession_to_threshold, must_be_sole_profession=False):
-    print(f'Filtering professions: must_be_sole_profession: {must_be_sole_profession}')
-    for profession, ref_count_threshold in profession_to_threshold.items():
-        if must_be_sole_profession:
-            filter_by_sole_profession(profession, ref_count_threshold)
-        else:
-            filter_by_profession(profession, ref_count_threshold)
+    with db_wrapper.Transaction() as cur, metrics.timer('stage_seconds', stage='professions'):
+        if previous_hash != keywords_hash:
+            applied = set(cur.execute("select keyword, profession from applied_keywords"))
+            apply_keyword_changes(cur, keywords, applied)
+            record_keywords(cur, keywords, keywords_hash)
 
-def filter_by_sole_profession(profession, ref_count_threshold):
-    with db_wrapper.DBManager() as cur:
-        cur.execute('''
-            delete from people where title in
-            (
-                select DISTINCT(a.title) 
-                from people as a,
-                people_to_profession as b
-                
-                where a.title = b.title and b.profession = ? 
-                and a.title in (select title from (select title, count(1) as num_professions from people_to_profession group by 1) where num_professions = 1)
-                and a.reference_count < ?
-            )
-            ''',
-            (profession, ref_count_threshold)
-        )
+        untagged = cur.execute("select title from people where tagged_at is null").fetchall()
+
+        # A summary may have changed since the person was last tagged
+        cur.executemany("delete from people_to_profession where title = ?", untagged)
+        tag_people(cur, keywords, 'tagged_at is null')
+        cur.execute("update people set tagged_at = ? where tagged_at is null", (time.time(),))
+        metrics.increment('rows', len(untagged), stage='professions')
+
+    print(f"people_to_profession table updated; tagged {len(untagged)} new people")
+
+# Returns the keywords to tag newly inserted people with, or None if
+# keyword_to_professions.csv has changed since the people_to_profession
+# table was last updated, in which case update_professions must run first.
+def current_keywords():
+    keywords, keywords_hash = load_keywords()
 
-def filter_by_profession(profession, ref_count_threshold):
     with db_wrapper.DBManager() as cur:
+        if db_wrapper.get_state(cur, 'keywords_hash') != keywords_hash:
+            return None
+
+    return keywords
+
+# Tags the people selected by the SQL condition 'which', with 'params' for
+# its placeholders, who haven't been tagged yet.  Used to tag people as
+# they are inserted rather than in a pass over the whole table.  Returns
+# the number of people tagged.
+def tag_untagged(cur, keywords, which, params=()):
+    which = f'tagged_at is null and {which}'
+    tag_people(cur, keywords, which, params)
+    cur.execute(f"update people set tagged_at = ? where {which}", (time.time(), *params))
+    return cur.rowcount
+
+# Applies the difference between the keywords in 'applied' and the current
+# 'keywords' to the people who are already tagged.
+def apply_keyword_changes(cur, keywords, applied):
+    added = keywords - applied
+    removed = applied - keywords
+    print(f'{len(added)} keywords added and {len(removed)} removed since the last update')
+
+    # A removed keyword can only be undone by re-matching its profession
+    # against every keyword that still maps to it.
+    redo = {profession for _, profession in removed}
+    cur.executemany("delete from people_to_profession where profession = ?",
+                    ((profession,) for profession in redo))
+
+    changed = {(keyword, profession) for keyword, profession in keywords if profession in redo}
+    changed |= added
+    if not changed:
+        return
+
+    tag_people(cur, changed, 'tagged_at is not null')
+
+# Returns the set of (keyword, profession) rows in the CSV and a hash of it
+def load_keywords():
+    with open(csv_name, 'rb') as csvfile:
+        keywords_hash = hashlib.sha256(csvfile.read()).hexdigest()
+
+    with open(csv_name, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        keywords = {(row['keyword'], row['profession']) for row in reader}
+
+    return keywords, keywords_hash
+
+def record_keywords(cur, keywords, keywords_hash):
+    cur.execute("delete from applied_keywords")
+    cur.executemany("insert into applied_keywords values (?, ?)", keywords)
+    db_wrapper.set_state(cur, 'keywords_hash', keywords_hash)
+
+# Adds the professions of the (keyword, profession) pairs in 'keywords' to
+# the people selected by the SQL condition 'which', with 'params' for its
+# placeholders.
+#
+# By default all keywords are matched in one pass over the first 300
+# characters of each summary, as substrings, which tags the same people
+# as a LIKE '%keyword%' query per keyword on that prefix.  With
+# tagger_match_mode set to 'fts', each keyword is instead looked up as a
+# phrase in the full-text index.  That avoids reading every summary, but
+# matches whole words anywhere in the summary rather than substrings of
+# its first 300 characters, so it tags people somewhat differently.
+def tag_people(cur, keywords, which, params=()):
+    if cfg.tagger_match_mode == 'fts':
+        for keyword, profession in keywords:
+            cur.execute(f'''
+                insert or ignore into people_to_profession
+                select p.title, ? from people_fts, people as p
+                where people_fts match ? and p.rowid = people_fts.rowid and {which}
+                ''', (profession, fts_phrase('summary', keyword), *params))
+        return
+
+    rows = cur.connection.execute(f"select title, substr(summary, 1, 300) from people where {which}",
+                                  params)
+    insert_professions(cur, keyword_matcher.KeywordMatcher(keywords), rows)
+
+# Returns an FTS5 query matching 'text' as a phrase in 'column'
+def fts_phrase(column, text):
+    escaped = text.strip().replace('"', '""')
+    return f'{column} : "{escaped}"'
+
+# Tags each (title, summary prefix) in 'rows' with the professions whose
+# keywords it contains, inserting the results in batches.
+def insert_professions(cur, matcher, rows, batch_size=10000):
+    batch = []
+
+    for title, summary in rows:
+        if summary is None:
+            continue
+
+        for profession in matcher.match(summary):
+            batch.append((title, profession))
+
+        if len(batch) >= batch_size:
+            cur.executemany("insert or ignore into people_to_profession values (?, ?)", batch)
+            batch = []
+
+    cur.executemany("insert or ignore into people_to_profession values (?, ?)", batch)
+
+# Removes people whose reference count is below a threshold for one of
+# their professions.  The thresholds are loaded into a temp table so that
+# each kind of rule is applied in one set-based pass, however many
+# professions are configured.
+def do_filter(dry_run=False):
+    start_count = db_wrapper.get_people_count()
+
+    with db_wrapper.Transaction() as cur:
+        find_filtered_people(cur)
+
+        if dry_run:
+            print_filtered_people(cur)
+            return
+
+        cur.execute('delete from people where title in (select title from filtered_people)')
+        # Drop the professions of the now deleted people
         cur.execute('''
-            delete from people where title in
-            (
-                select DISTINCT(a.title) from people as a, people_to_profession as b
-                where a.title = b.title and b.profession = ?
-                and a.reference_count < ?
-            )
-            ''',
-            (profession, ref_count_threshold)
+            delete from people_to_profession
+            where title in (select title from filtered_people)
+            ''')
+
+    end_count = db_wrapper.get_people_count()
+    print(f'Removed {start_count - end_count} people')
+
+# Fills the temp table filtered_people with a (title, profession, sole)
+# row for every person below the threshold configured for one of their
+# professions.  sole is 1 for rules that only apply when it is the
+# person's sole profession.
+def find_filtered_people(cur):
+    cur.execute('''
+        create temp table if not exists profession_thresholds (
+            profession TEXT,
+            min_ref_count INTEGER,
+            sole INTEGER,
+            UNIQUE(profession, sole)
         )
+        ''')
+    cur.execute('''
+        create temp table if not exists filtered_people (
+            title TEXT,
+            profession TEXT,
+            sole INTEGER
+        )
+        ''')
+    cur.execute('delete from profession_thresholds')
+    cur.execute('delete from filtered_people')
+
+    for thresholds, sole in ((cfg.min_ref_counts_per_profession, 0),
+                             (cfg.min_ref_counts_per_sole_profession, 1)):
+        cur.executemany('insert into profession_thresholds values (?, ?, ?)',
+                        ((profession, threshold, sole)
+                         for profession, threshold in (thresholds or {}).items()))
+
+    cur.execute('''
+        insert into filtered_people
+        select b.title, b.profession, t.sole
+        from profession_thresholds as t, people_to_profession as b, people as a
+        where t.sole = 0 and b.profession = t.profession
+        and a.title = b.title and a.reference_count < t.min_ref_count
+        ''')
+
+    cur.execute('''
+        insert into filtered_people
+        select b.title, b.profession, t.sole
+        from profession_thresholds as t, people_to_profession as b, people as a
+        where t.sole = 1 and b.profession = t.profession
+        and a.title = b.title and a.reference_count < t.min_ref_count
+        and not exists (select 1 from people_to_profession as c
+                        where c.title = b.title and c.profession != b.profession)
+        ''')
+
+def print_filtered_people(cur):
+    query = '''
+        select profession, sole, count(1) from filtered_people
+        group by 1, 2
+        order by 3 DESC
+        '''
+    for profession, sole, count in cur.execute(query):
+        rule = 'sole profession' if sole else 'profession'
+        print(f'{profession} ({rule}): {count}')
+
+    total = cur.execute('select count(distinct title) from filtered_people').fetchone()[0]
+    print(f'Would remove {total} people')
 
 def print_profession_summary():
     with db_wrapper.DBManager() as cur:
@@ -105,6 +280,28 @@ def print_profession_members(profession):
         for row in cur.execute(query, (profession,)):
             print(f'{row[0]:<40} Refs:{row[1]:<10} Year:{row[2]}')
 
+# Prints the people whose title or summary matches the full-text 'query',
+# best matches of the most referenced people first
+def print_search_results(query):
+    with db_wrapper.DBManager() as cur:
+        sql = '''
+            select p.title, p.reference_count, p.birth_year,
+                   snippet(people_fts, 1, '[', ']', '...', 12)
+            from people_fts, people as p
+            where people_fts match ? and p.rowid = people_fts.rowid
+            order by bm25(people_fts) * p.reference_count
+            limit ?
+            '''
+        try:
+            rows = cur.execute(sql, (query, cfg.search_result_limit)).fetchall()
+        except sqlite3.OperationalError as e:
+            print(f'ERROR: bad search query: {e}')
+            return
+
+        for row in rows:
+            print(f'{row[0]:<40} Refs:{row[1]:<10} Year:{row[2]}')
+            print(f'    {row[3]}')
+
 def get_professions(title):
     with db_wrapper.DBManager() as cur:
         query = '''
@@ -0,0 +1,128 @@
+# Limits on how hard we hit Wikimedia's servers.
+#
+# A single token bucket and a single concurrency limit are shared by every
+# thread in the process, so adding more workers never raises the request
+# rate above what is configured in config.yaml.
+#
+# The concurrency limit adapts to how the servers are coping: it grows
+# slowly while requests succeed quickly and halves whenever a request is
+# throttled (429, 503, maxlag), fails with a network error or timeout, or
+# is slow, up to max_concurrent_requests.
+
+import threading
+import time
+from contextlib import contextmanager
+
+from config import cfg
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Blocks until 'cost' tokens are available.  A rate <= 0 means unlimited.
+    def acquire(self, cost=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                    self.last = now
+
+                    if self.tokens >= cost:
+                        self.tokens -= cost
+                        return
+
+                    wait = (cost - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    # Stops handing out tokens for 'seconds', e.g. when a server sends
+    # Retry-After
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Gives this process 1/parts of the rate, for when 'parts' processes
+    # share one budget
+    def share(self, parts):
+        with self.lock:
+            self.rate = self.rate / parts
+            self.burst = max(self.burst / parts, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+# A concurrency limit that is raised additively and cut multiplicatively
+# (AIMD), like TCP congestion control
+class AdaptiveConcurrency():
+    def __init__(self, max_limit):
+        self.max_limit = max(max_limit, 1)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded):
+        with self.cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                # Grows by about one per limit's worth of good requests
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    # Gives this process 1/parts of the concurrency limit, for when 'parts'
+    # processes share one cap
+    def share(self, parts):
+        with self.cond:
+            self.max_limit = max(self.max_limit // parts, 1)
+            self.limit = max(min(self.limit / parts, float(self.max_limit)), 1.0)
+
+class SlotOutcome():
+    def __init__(self):
+        self.overloaded = False
+
+class RequestGate():
+    def __init__(self, rate, burst, max_concurrency):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+
+    # Wrap each HTTP request in this.  'cost' is the number of HTTP requests
+    # the block is expected to make.  Set overloaded on the yielded outcome
+    # if the server said it is overloaded.
+    @contextmanager
+    def slot(self, cost=1):
+        self.concurrency.acquire()
+        outcome = SlotOutcome()
+        start = time.monotonic()
+
+        try:
+            self.bucket.acquire(cost)
+            start = time.monotonic()
+            yield outcome
+        finally:
+            slow = time.monotonic() - start > cfg.slow_request_seconds
+            self.concurrency.release(outcome.overloaded or slow)
+
+    # Gives this process 1/parts of both the rate and the concurrency limit
+    def share(self, parts):
+        self.bucket.share(parts)
+        self.concurrency.share(parts)
+
+# Shared by all requests to the Wikipedia API and pages
+api = RequestGate(cfg.max_requests_per_second, cfg.max_requests_burst,
+                  cfg.max_concurrent_requests)
@@ -0,0 +1,102 @@
+# An index of the reference counts of everyone in every crawled birth year
+# file, for answering "how many people have at least N references" without
+# reading the files again.
+#
+# ref_count_index holds a (ref_count, year, title, estimated) row per
+# person, indexed by reference count.  ref_count_histogram holds how many
+# people in each year have each reference count, and how many have at
+# least that many, so counts above a threshold only need one histogram row
+# per year.  People whose reference count was only estimated are left out
+# of the histogram.
+
+import db_wrapper
+
+# Replaces the index entries for 'year' with the people in 'columns', a
+# birth_year_binary.PeopleColumns.  'mtime' is the modification time of
+# the birth year file they came from.
+def index_year(year, columns, mtime):
+    with db_wrapper.Transaction() as cur:
+        cur.execute("delete from ref_count_index where year = ?", (year,))
+        cur.execute("delete from ref_count_histogram where year = ?", (year,))
+
+        cur.executemany("insert into ref_count_index values (?, ?, ?, ?)",
+                        ((ref_count, year, title, estimated)
+                         for title, ref_count, _, estimated in columns))
+        rebuild_histogram(cur, year)
+
+        cur.execute("insert or replace into ref_count_indexed_years values (?, ?)", (year, mtime))
+
+# Replaces the histogram rows for 'year' with counts from ref_count_index
+def rebuild_histogram(cur, year):
+    cur.execute("delete from ref_count_histogram where year = ?", (year,))
+    cur.execute('''
+        insert into ref_count_histogram (year, ref_count, people, at_least)
+        select year, ref_count, people, sum(people) over (order by ref_count desc)
+        from (
+            select year, ref_count, count(1) as people from ref_count_index
+            where year = ? and not estimated
+            group by 2
+        )
+        ''', (year,))
+
+# Returns the modification time of the file 'year' was last indexed from,
+# or None if it hasn't been
+def indexed_mtime(year):
+    with db_wrapper.DBManager() as cur:
+        row = cur.execute("select mtime from ref_count_indexed_years where year = ?",
+                          (year,)).fetchone()
+
+    return row[0] if row else None
+
+# Prints how many people have at least min_ref_count references, per year
+# or per decade.  The years are listed by seeking to each one in the
+# histogram's primary key, and each year's count is the at_least of its
+# lowest reference count that meets the threshold.
+def print_counts(min_ref_count, by='decade'):
+    with db_wrapper.DBManager() as cur:
+        query = '''
+            with recursive years(year) as (
+                select min(year) from ref_count_histogram
+                union all
+                select (select min(year) from ref_count_histogram where year > years.year)
+                from years where year is not null
+            )
+            select year, (select at_least from ref_count_histogram as h
+                          where h.year = years.year and h.ref_count >= ?
+                          order by h.ref_count limit 1)
+            from years where year is not null
+            '''
+        counts = {}
+        for year, people in cur.execute(query, (min_ref_count,)):
+            if people is None:
+                continue
+            key = period_of(year, by)
+            counts[key] = counts.get(key, 0) + people
+
+        estimated = cur.execute('''
+            select count(1) from ref_count_index
+            where estimated and ref_count >= ?
+            ''', (min_ref_count,)).fetchone()[0]
+
+    print(f'People with at least {min_ref_count} references:')
+    for key, people in counts.items():
+        print(f'{period_label(key):<12} {people}')
+    print(f'{"Total":<12} {sum(counts.values())}')
+
+    if estimated:
+        print(f'{estimated} more people might have, but their reference counts were only estimated')
+
+# Returns (is BC, year or first year of the decade, label suffix) for the
+# period 'year' is counted in.  Decades BC count back from 1 BC, so 19 BC
+# to 10 BC are the 10s BC, and 9 BC to 1 BC are the 0s BC, which are kept
+# apart from the 0s.
+def period_of(year, by):
+    decade = by == 'decade' and year < 3000
+    number = abs(year) // 10 * 10 if decade else abs(year)
+    return (year < 0, number, 's' if decade else '')
+
+def period_label(period):
+    bc, number, suffix = period
+    if bc:
+        return f'{number}{suffix} BC'
+    return f'{number}{suffix}'
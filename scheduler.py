@@ -0,0 +1,168 @@
+# Runs a --summary year range as one job per birth year, spread across a
+# pool of worker processes.
+#
+# The state of each year's job is kept in the year_jobs table.  Within a
+# run, failed years are retried with exponential backoff until
+# year_max_attempts is reached.  Each new run starts every year in its
+# range again with a fresh set of attempts: years whose birth year file
+# exists skip the crawl, so finished years only repeat the cheap
+# summarizing step, which picks up anyone who newly meets
+# min_ref_count_for_summary.  Years whose file was deleted are crawled
+# again, and interrupted crawls resume from their checkpoint.
+
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import db_wrapper
+import http_cache
+import image_store
+import metrics
+import pipeline
+import rate_limiter
+import wiki_by_birth_year
+import wiki_summary
+
+from config import cfg
+
+def run_years(year_start, year_end):
+    queue_years(year_start, year_end)
+
+    workers = cfg.year_workers
+
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(workers,)) as pool:
+        running = {}
+
+        while True:
+            free = workers - len(running)
+            for year in next_years(year_start, year_end, free, running.values()):
+                running[pool.submit(run_year_job, year)] = year
+
+            if not running:
+                delay = seconds_until_next_retry(year_start, year_end)
+                if delay is None:
+                    break
+                time.sleep(delay)
+                continue
+
+            done, _ = wait(running, timeout=5, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                metrics.merge(future.result())
+
+    print_failed_years(year_start, year_end)
+
+# Adds a pending job for each year in the range that doesn't have one yet,
+# and makes every other year in the range pending again with no attempts
+# used
+def queue_years(year_start, year_end):
+    with db_wrapper.Transaction() as cur:
+        cur.executemany("insert or ignore into year_jobs (year, state) values (?, 'pending')",
+                        ((year,) for year in range(year_start, year_end + 1)))
+        cur.execute('''
+            update year_jobs
+            set state = 'pending', attempts = 0, last_error = NULL, next_attempt_at = 0
+            where year between ? and ?
+            ''', (year_start, year_end))
+
+# Returns up to 'limit' years that are ready to run
+def next_years(year_start, year_end, limit, running_years):
+    if limit <= 0:
+        return []
+
+    with db_wrapper.DBManager() as cur:
+        res = cur.execute('''
+            select year from year_jobs
+            where year between ? and ?
+            and (state = 'pending'
+                 or (state = 'failed' and attempts < ? and next_attempt_at <= ?))
+            order by year
+            ''', (year_start, year_end, cfg.year_max_attempts, time.time()))
+        years = [row[0] for row in res if row[0] not in running_years]
+
+    return years[:limit]
+
+# Returns how long to wait for the next failed year to become retryable,
+# or None if there is nothing left to retry
+def seconds_until_next_retry(year_start, year_end):
+    with db_wrapper.DBManager() as cur:
+        res = cur.execute('''
+            select min(next_attempt_at) from year_jobs
+            where year between ? and ? and state = 'failed' and attempts < ?
+            ''', (year_start, year_end, cfg.year_max_attempts))
+        next_attempt_at = res.fetchone()[0]
+
+    if next_attempt_at is None:
+        return None
+
+    return max(next_attempt_at - time.time(), 0)
+
+def print_failed_years(year_start, year_end):
+    with db_wrapper.DBManager() as cur:
+        res = cur.execute('''
+            select year, attempts, last_error from year_jobs
+            where year between ? and ? and state = 'failed'
+            order by year
+            ''', (year_start, year_end))
+        for year, attempts, last_error in res:
+            print(f'Year {year} failed after {attempts} attempts: {last_error}')
+
+# sqlite connections the worker inherited from the parent when it was
+# forked.  They are never used or closed, only kept alive.
+inherited_connections = []
+
+# Runs in each worker process.  The workers split the configured request
+# rate and concurrency limit between them so that together they stay
+# within them.  Their metrics
+# start empty, since they are forked with a copy of the parent's.
+def init_worker(workers):
+    # Each worker opens its own sqlite connections
+    inherited_connections.extend([db_wrapper.abandon_connection(), http_cache.conn,
+                                  image_store.conn])
+    http_cache.conn = None
+    image_store.conn = None
+
+    rate_limiter.api.share(workers)
+    metrics.collect()
+
+# Returns the metrics recorded while running the job, for the parent to
+# merge into the run's
+def run_year_job(year):
+    print(f'\n====== Working on year {year} ======')
+
+    try:
+        set_job_state(year, 'crawling')
+        summarized = False
+        if cfg.streaming_pipeline:
+            summarized = pipeline.crawl_and_summarize(year)
+        else:
+            wiki_by_birth_year.write_birth_year_file(year)
+
+        # A streamed crawl has already summarized everyone it counted
+        set_job_state(year, 'summarizing')
+        if not summarized and not wiki_summary.insert_summaries_for_year(year):
+            raise RuntimeError('birth year file was not written')
+
+        set_job_state(year, 'done')
+    except Exception as e:
+        print(f'Year {year} failed: {e!r}')
+        record_job_failure(year, e)
+
+    return metrics.collect()
+
+def set_job_state(year, state):
+    with db_wrapper.DBManager() as cur:
+        cur.execute("update year_jobs set state = ? where year = ?", (state, year))
+
+def record_job_failure(year, error):
+    with db_wrapper.DBManager() as cur:
+        attempts = cur.execute("select attempts from year_jobs where year = ?",
+                               (year,)).fetchone()[0] + 1
+        delay = cfg.year_retry_base_seconds * 2 ** (attempts - 1)
+        cur.execute('''
+            update year_jobs
+            set state = 'failed', attempts = ?, last_error = ?, next_attempt_at = ?
+            where year = ?
+            ''', (attempts, repr(error), time.time() + delay, year))
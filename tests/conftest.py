@@ -0,0 +1,40 @@
+# config.yaml is read from the working directory when config is first
+# imported, so the tests run from the repository root like main.py does.
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+from config import cfg
+import db_wrapper
+import image_store
+
+# A fresh people.db, and image store, in a temporary output directory
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, 'output_directory', str(tmp_path))
+    monkeypatch.setattr(image_store, 'conn', None)
+    db_wrapper.close_connection()
+    db_wrapper.initialize_tables()
+    yield
+    db_wrapper.close_connection()
+    if image_store.conn is not None:
+        image_store.conn.close()
+
+# A StubWiki standing in for the MediaWiki API, with the response cache off
+@pytest.fixture
+def wiki(db, monkeypatch):
+    from stub_server import StubWiki
+
+    stub = StubWiki().start()
+    monkeypatch.setattr(cfg, 'api_url', stub.api_url)
+    monkeypatch.setattr(cfg, 'http_cache_enabled', False)
+    yield stub
+    stub.stop()
@@ -0,0 +1,75 @@
+# Writes the small multistream dump used by test_dump_ingest.py:
+#   pages-articles-multistream.xml.bz2    two pages per bz2 stream
+#   pages-articles-multistream-index.txt.bz2
+#   categorylinks.sql.gz
+#
+# Run from this directory to regenerate them after changing the pages.
+
+import bz2
+import gzip
+from xml.sax.saxutils import escape
+
+PAGES_PER_STREAM = 2
+
+ADA_LOVELACE = """{{Infobox person|name=Ada Lovelace|image=Ada.jpg}}
+'''Ada Lovelace''' (10 December 1815 – 27 November 1852) was an [[England|English]] [[mathematician]].<ref name="a">{{cite web|url=x}}</ref> She wrote notes<ref>b</ref><ref name="a"/>.
+[[File:Ada.jpg|thumb|Portrait of [[Ada Lovelace|Ada]]]]
+<!-- hidden -->She is known for [https://example.org an external link] &amp; more.
+== Life ==
+Lots more <ref>c</ref>
+[[Category:1815 births]]
+"""
+
+# (page id, title, namespace, redirect target, wikitext)
+PAGES = [
+    (1, 'Ada Lovelace', 0, None, ADA_LOVELACE),
+    (2, 'Low Ref', 0, None, 'Someone<ref>a</ref> [[Category:1900 births]]'),
+    (3, 'Talk:Low Ref', 1, None, '[[Category:1900 births]]'),
+    (4, 'Ada L', 0, 'Ada Lovelace', '#REDIRECT [[Ada Lovelace]] [[Category:1815 births]]'),
+    # Only in a birth year category through a template, so only
+    # categorylinks.sql.gz knows about it
+    (5, 'Templ Person', 0, None, '{{Birth category|1950}}<ref/><ref/><ref/>'),
+    (6, 'BC Guy', 0, None, 'Old<ref>1</ref><ref>2</ref><ref>3</ref>[[Category:45 BC births]]'),
+    (7, 'Not a person', 0, None, 'A rock<ref/><ref/><ref/>'),
+]
+
+HEADER = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xml:lang="en">'
+          '<siteinfo><sitename>Wikipedia</sitename></siteinfo>\n')
+
+CATEGORYLINKS = ("-- MySQL dump\n"
+                 "INSERT INTO `categorylinks` VALUES (5,'1950_births','a',''),"
+                 "(7,'Rocks','b',''),(6,'45_BC_births','c','');\n")
+
+def page_xml(pageid, title, ns, redirect, text):
+    redirect = f'<redirect title="{escape(redirect)}" />' if redirect else ''
+    return (f'<page><title>{escape(title)}</title><ns>{ns}</ns><id>{pageid}</id>{redirect}'
+            f'<revision><id>{pageid + 900}</id>'
+            f'<text bytes="{len(text)}" xml:space="preserve">{escape(text)}</text></revision></page>\n')
+
+def main():
+    streams = [bz2.compress(HEADER.encode())]
+    index = []
+    offset = len(streams[0])
+
+    for i in range(0, len(PAGES), PAGES_PER_STREAM):
+        chunk = PAGES[i:i + PAGES_PER_STREAM]
+        xml = ''.join(page_xml(*page) for page in chunk)
+        if i + PAGES_PER_STREAM >= len(PAGES):
+            xml += '</mediawiki>\n'
+
+        index += [f'{offset}:{pageid}:{title}' for pageid, title, _, _, _ in chunk]
+        streams.append(bz2.compress(xml.encode()))
+        offset += len(streams[-1])
+
+    with open('pages-articles-multistream.xml.bz2', 'wb') as f:
+        f.write(b''.join(streams))
+
+    with open('pages-articles-multistream-index.txt.bz2', 'wb') as f:
+        f.write(bz2.compress(('\n'.join(index) + '\n').encode()))
+
+    # mtime=0 so that the file only changes when its content does
+    with open('categorylinks.sql.gz', 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+        f.write(CATEGORYLINKS.encode())
+
+if __name__ == '__main__':
+    main()
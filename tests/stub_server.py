@@ -0,0 +1,200 @@
+# A local stand-in for the MediaWiki API and Wikimedia's image server, for
+# the tests and the benchmarks in bench/.
+#
+# It answers the requests wiki-people makes: category listings, batched
+# page queries (info, extracts, extlinks and pageimages, following
+# redirects), revisions by page id, the lead section's HTML, and image
+# downloads.  Each response can be delayed by 'latency' seconds to stand
+# in for the network, and fail_next() makes the next requests fail or hang.
+#
+#   wiki = StubWiki(latency=0.05)
+#   wiki.add_person('Ada Lovelace', 1815, ref_count=40)
+#   wiki.start()
+#   cfg.api_url = wiki.api_url
+
+import json
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from config import cfg
+import wiki_by_birth_year
+
+Page = namedtuple('Page', ['pageid', 'revid', 'ref_count', 'extract', 'redirect'])
+
+# Category listings are split into pages of this many members, like the
+# API's cmlimit
+CATEGORY_PAGE_SIZE = 500
+
+# The body of every image; a JPEG header and some padding
+IMAGE_BYTES = b'\xff\xd8\xff\xe0' + bytes(range(256)) * 40
+
+class StubWiki():
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.pages = {}
+        self.categories = {}
+        self.requests = 0
+        self.faults = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    # Adds a page about a person born in 'year', listed in the year's
+    # category
+    def add_person(self, title, year, ref_count, extract=None):
+        self.add_page(title, ref_count, extract or f'{title} was an American actor.')
+        category = wiki_by_birth_year.year_to_category_name(year)
+        self.categories.setdefault(category, []).append(title)
+
+    def add_page(self, title, ref_count=0, extract='', redirect=None):
+        pageid = len(self.pages) + 1
+        self.pages[title] = Page(pageid, pageid + 1000, ref_count, extract, redirect)
+
+    # Makes the next request answer with 'status' and a Retry-After of
+    # 'retry_after' seconds, if given, after waiting 'delay' seconds
+    def fail_next(self, status=None, retry_after=None, delay=0):
+        with self.lock:
+            self.faults.append((status, retry_after, delay))
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def api_url(self):
+        return f'{self.url}/w/api.php'
+
+    def image_url(self, title):
+        return f'{self.url}/images/{urllib.parse.quote(title)}.jpg'
+
+    def handle(self, request):
+        with self.lock:
+            self.requests += 1
+            fault = self.faults.pop(0) if self.faults else None
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fault:
+            status, retry_after, delay = fault
+            time.sleep(delay)
+            if status:
+                return self.send(request, b'', 'text/plain', status,
+                                 {'Retry-After': str(retry_after)} if retry_after is not None else {})
+
+        url = urllib.parse.urlparse(request.path)
+        if url.path.startswith('/images/'):
+            return self.send(request, IMAGE_BYTES, 'image/jpeg')
+
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if params.get('action') == 'parse':
+            result = self.parse(params)
+        elif params.get('list') == 'categorymembers':
+            result = self.category_members(params)
+        else:
+            result = self.query(params)
+
+        self.send(request, json.dumps(result).encode(), 'application/json')
+
+    def send(self, request, body, content_type, status=200, headers={}):
+        try:
+            request.send_response(status)
+            request.send_header('Content-Type', content_type)
+            request.send_header('Content-Length', str(len(body)))
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.end_headers()
+            request.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting
+            pass
+
+    def category_members(self, params):
+        members = self.categories.get(params['cmtitle'], [])
+        start = int(params.get('cmcontinue', 0))
+        end = start + CATEGORY_PAGE_SIZE
+
+        result = {'query': {'categorymembers': [{'ns': 0, 'title': title}
+                                                for title in members[start:end]]}}
+        if end < len(members):
+            result['continue'] = {'cmcontinue': str(end), 'continue': '-||'}
+        return result
+
+    def query(self, params):
+        if 'pageids' in params:
+            return self.query_pageids(params)
+
+        pages = []
+        redirects = []
+
+        for title in params['titles'].split('|'):
+            page = self.pages.get(title)
+            if page is not None and page.redirect:
+                redirects.append({'from': title, 'to': page.redirect})
+                title = page.redirect
+                page = self.pages.get(title)
+
+            if page is None:
+                pages.append({'title': title, 'missing': True})
+                continue
+
+            pages.append({
+                'title': title,
+                'pageid': page.pageid,
+                'ns': 0,
+                'lastrevid': page.revid,
+                'length': 500 + 100 * page.ref_count,
+                'extract': page.extract,
+                'extlinks': [{'url': f'https://example.org/{i}'} for i in range(page.ref_count)],
+                'thumbnail': {'source': self.image_url(title)},
+            })
+
+        query = {'pages': pages}
+        if redirects:
+            query['redirects'] = redirects
+        return {'query': query}
+
+    # The latest revision of pages looked up by id, as for --refresh
+    def query_pageids(self, params):
+        by_id = {page.pageid: (title, page) for title, page in self.pages.items()}
+        pages = []
+
+        for pageid in map(int, params['pageids'].split('|')):
+            if pageid not in by_id:
+                pages.append({'pageid': pageid, 'missing': True})
+                continue
+
+            title, page = by_id[pageid]
+            pages.append({'title': title, 'pageid': pageid, 'ns': 0, 'lastrevid': page.revid})
+
+        return {'query': {'pages': pages}}
+
+    def parse(self, params):
+        title = params['page']
+        if title not in self.pages:
+            return {'error': {'code': 'missingtitle', 'info': "The page you specified doesn't exist."}}
+
+        html = (f'<table class="infobox"><tr><td><img src="//upload.wikimedia.org/wikipedia/'
+                f'commons/thumb/a/ab/{title}.jpg/{cfg.image_max_dimension}px-{title}.jpg" '
+                f'width="{cfg.image_max_dimension}"></td></tr></table>')
+        return {'parse': {'title': title, 'text': html}}
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import birth_year_binary
+import wiki_by_birth_year
+from birth_year_binary import PeopleColumns
+from config import cfg
+
+LINES = '''\
+120 -45 |Gaius Example
+~30 -45 |Short Page
+7 -45 |Zoë Ünicode (poet)
+61 -45 |Exactly Sixty-one
+not a person line
+'''
+
+PEOPLE = [('Gaius Example', 120, -45, False), ('Short Page', 30, -45, True),
+          ('Zoë Ünicode (poet)', 7, -45, False), ('Exactly Sixty-one', 61, -45, False)]
+
+@pytest.fixture
+def people_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, 'output_directory', str(tmp_path))
+    fname = wiki_by_birth_year.year_to_filename(-45)
+    os.makedirs(os.path.dirname(fname))
+    with open(fname, 'w', encoding='utf-8') as f:
+        f.write(LINES)
+    return fname
+
+def test_text_file_keeps_bc_years_and_estimates(people_file, capsys):
+    assert list(wiki_by_birth_year.iterate_people_file(people_file)) == PEOPLE
+    assert 'not a person line' in capsys.readouterr().out
+
+def test_binary_copy_holds_the_same_people(people_file):
+    assert wiki_by_birth_year.convert_people_file(people_file) == len(PEOPLE)
+
+    columns = birth_year_binary.read_file(people_file + '.bin')
+    assert list(columns) == PEOPLE
+    assert list(columns.ref_counts) == [120, 30, 7, 61]
+    assert list(columns.years) == [-45] * 4
+
+def test_above_skips_low_and_estimated_reference_counts():
+    columns = PeopleColumns.from_rows(PEOPLE)
+
+    assert list(columns.above(61)) == [('Gaius Example', 120, -45), ('Exactly Sixty-one', 61, -45)]
+    assert list(columns.above(200)) == []
+    assert columns.estimated_above(20) == 1
+    assert columns.estimated_above(31) == 0
+
+def test_other_versions_are_rejected(people_file):
+    wiki_by_birth_year.convert_people_file(people_file)
+    with open(people_file + '.bin', 'r+b') as f:
+        f.write(birth_year_binary.header.pack(birth_year_binary.MAGIC, 1, len(PEOPLE)))
+
+    with pytest.raises(ValueError, match='version 1 birth year file'):
+        birth_year_binary.read_file(people_file + '.bin')
+
+def test_stale_binary_copy_is_not_used(people_file):
+    wiki_by_birth_year.convert_people_file(people_file)
+    assert len(wiki_by_birth_year.load_people_columns(people_file)) == len(PEOPLE)
+
+    with open(people_file, 'a', encoding='utf-8') as f:
+        f.write('5 -45 |Added Later\n')
+    mtime = os.path.getmtime(people_file + '.bin') + 10
+    os.utime(people_file, (mtime, mtime))
+
+    assert len(wiki_by_birth_year.load_people_columns(people_file)) == len(PEOPLE) + 1
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import stub_server
+import wiki_by_birth_year
+from config import cfg
+
+YEAR = 1950
+
+@pytest.fixture
+def crawl(wiki, monkeypatch):
+    # Several pages of category members, each several request batches long
+    monkeypatch.setattr(stub_server, 'CATEGORY_PAGE_SIZE', 120)
+    monkeypatch.setattr(cfg, 'crawl_prefilter', False)
+
+    for i in range(300):
+        wiki.add_person(f'Person {i}', YEAR, ref_count=i % 97)
+    # Listed in the category under a title that redirects
+    wiki.add_page('Old Person 7', redirect='Person 7')
+    wiki.categories[wiki_by_birth_year.year_to_category_name(YEAR)].insert(50, 'Old Person 7')
+
+    def crawl(max_concurrent_requests):
+        monkeypatch.setattr(cfg, 'max_concurrent_requests', max_concurrent_requests)
+        fname = wiki_by_birth_year.year_to_filename(YEAR)
+        if os.path.exists(fname):
+            os.remove(fname)
+
+        wiki_by_birth_year.write_birth_year_file(YEAR)
+        with open(fname, 'rb') as f:
+            return f.read()
+
+    return crawl
+
+def test_concurrent_crawl_matches_serial(crawl):
+    serial = crawl(1)
+    assert crawl(8) == serial
+
+    expected = ''.join(f'{i % 97} {YEAR} |Person {i}\n' for i in range(300))
+    assert serial.decode('utf-8') == expected
+
+def test_crawled_file_can_be_read_back(crawl):
+    crawl(4)
+
+    people = list(wiki_by_birth_year.iterate_birth_year_file(YEAR))
+    assert people[:2] == [('Person 0', 0, YEAR, False), ('Person 1', 1, YEAR, False)]
+    assert len(people) == 300
@@ -0,0 +1,42 @@
+import pytest
+
+import db_wrapper
+
+def states():
+    with db_wrapper.DBManager() as cur:
+        return {name for name, in cur.execute('select name from run_state')}
+
+def test_nested_transaction_rolls_back_only_its_own_changes(db):
+    with db_wrapper.DBManager() as cur:
+        db_wrapper.set_state(cur, 'outer', '1')
+
+        with pytest.raises(ValueError):
+            with db_wrapper.Transaction() as inner:
+                db_wrapper.set_state(inner, 'inner', '1')
+                raise ValueError
+
+        db_wrapper.set_state(cur, 'after', '1')
+
+    assert states() == {'outer', 'after'}
+
+def test_transaction_rolls_back_nested_contexts(db):
+    with pytest.raises(ValueError):
+        with db_wrapper.Transaction():
+            with db_wrapper.DBManager() as cur:
+                db_wrapper.set_state(cur, 'nested', '1')
+            with db_wrapper.Transaction() as cur:
+                db_wrapper.set_state(cur, 'nested transaction', '1')
+            raise ValueError
+
+    assert states() == set()
+
+def test_commit_is_refused_inside_a_transaction(db):
+    with db_wrapper.DBManager() as cur:
+        with pytest.raises(RuntimeError):
+            with db_wrapper.Transaction() as inner:
+                db_wrapper.commit(inner)
+
+        db_wrapper.set_state(cur, 'committed', '1')
+        db_wrapper.commit(cur)
+
+    assert states() == {'committed'}
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import db_wrapper
+import dump_ingest
+from config import cfg
+from conftest import FIXTURES
+
+DUMP = os.path.join(FIXTURES, 'pages-articles-multistream.xml.bz2')
+INDEX = os.path.join(FIXTURES, 'pages-articles-multistream-index.txt.bz2')
+CATEGORYLINKS = os.path.join(FIXTURES, 'categorylinks.sql.gz')
+
+@pytest.fixture(autouse=True)
+def dump_config(monkeypatch):
+    monkeypatch.setattr(cfg, 'min_ref_count_for_summary', 3)
+    monkeypatch.setattr(cfg, 'dump_insert_batch_size', 2)
+    monkeypatch.setattr(cfg, 'dump_streams_per_task', 2)
+    monkeypatch.setattr(cfg, 'dump_workers', 2)
+    monkeypatch.setattr(dump_ingest, 'years_by_pageid', {})
+    dump_ingest.load_birth_categories()
+
+def flatten(batches):
+    return sorted(row for batch in batches for row in batch)
+
+def test_parse_dump():
+    batches = list(dump_ingest.parse_dump(DUMP))
+    assert all(len(batch) <= cfg.dump_insert_batch_size for batch in batches)
+
+    rows = {row[0]: row for row in flatten(batches)}
+    # The talk page, the redirect, the page without a birth year category
+    # and the one only categorized by a template are left out
+    assert sorted(rows) == ['Ada Lovelace', 'BC Guy', 'Low Ref']
+
+    title, pageid, revid, year, ref_count, summary = rows['Ada Lovelace']
+    assert (pageid, revid, year, ref_count) == (1, 901, 1815, 4)
+    assert summary.startswith('Ada Lovelace (10 December 1815 – 27 November 1852) was an English mathematician.')
+    assert 'Portrait' not in summary and 'hidden' not in summary and 'Life' not in summary
+
+    assert rows['BC Guy'][3] == -45
+    # Below min_ref_count_for_summary, so no summary
+    assert rows['Low Ref'][4:] == (1, None)
+
+def test_parse_streams_in_parallel_matches_parse_dump():
+    assert dump_ingest.read_stream_offsets(INDEX)[0] > 0
+
+    assert flatten(dump_ingest.parse_streams_in_parallel(DUMP, INDEX)) == \
+        flatten(dump_ingest.parse_dump(DUMP))
+
+def test_categorylinks_add_template_categories(monkeypatch):
+    years = dump_ingest.load_categorylinks(CATEGORYLINKS)
+    assert years == {5: 1950, 6: -45}
+    monkeypatch.setattr(dump_ingest, 'years_by_pageid', years)
+
+    rows = flatten(dump_ingest.parse_streams_in_parallel(DUMP, INDEX))
+    assert [row[0] for row in rows] == ['Ada Lovelace', 'BC Guy', 'Low Ref', 'Templ Person']
+    assert flatten(dump_ingest.parse_dump(DUMP)) == rows
+
+def test_ingest_dump(db):
+    dump_ingest.ingest_dump(DUMP, INDEX, CATEGORYLINKS)
+
+    with db_wrapper.DBManager() as cur:
+        people = cur.execute('select title, pageid, lastrevid, birth_year, reference_count from people '
+                             'order by title').fetchall()
+        index = cur.execute('select title from ref_count_index order by title').fetchall()
+
+    # Low Ref is indexed, but is below min_ref_count_for_summary
+    assert people == [('Ada Lovelace', 1, 901, 1815, 4), ('BC Guy', 6, 906, -45, 3),
+                      ('Templ Person', 5, 905, 1950, 3)]
+    assert [title for title, in index] == ['Ada Lovelace', 'BC Guy', 'Low Ref', 'Templ Person']
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import db_wrapper
+import image_retriever
+import stub_server
+from config import cfg
+
+PEOPLE = [f'Person {i}' for i in range(30)]
+
+@pytest.fixture
+def people(wiki, monkeypatch):
+    # The stub's lead images point back at it, unlike the upload.wikimedia.org
+    # urls in its infoboxes
+    monkeypatch.setattr(cfg, 'image_url_source', 'pageimages')
+    monkeypatch.setattr(cfg, 'image_download_workers', 4)
+    monkeypatch.setattr(cfg, 'image_db_batch_size', 7)
+    monkeypatch.setattr(image_retriever.download_gate.bucket, 'rate', 0)
+
+    for title in PEOPLE:
+        wiki.add_person(title, 1950, ref_count=10)
+
+    with db_wrapper.DBManager() as cur:
+        cur.executemany("insert into people (title, birth_year, reference_count, summary) values (?, 1950, 10, '')",
+                        ((title,) for title in PEOPLE + ['Deleted Person']))
+
+def image_rows():
+    with db_wrapper.DBManager() as cur:
+        return {title: (fname, status, attempts) for title, fname, status, attempts in
+                cur.execute('select title, image_fname, image_status, image_attempts from people')}
+
+def test_images_are_streamed_to_files(people):
+    image_retriever.get_images()
+
+    rows = image_rows()
+    assert rows.pop('Deleted Person') == ('no image available', 'none', 1)
+
+    for title in PEOPLE:
+        fname, status, attempts = rows[title]
+        assert (fname, status, attempts) == \
+            (f'{cfg.output_directory}/images/{title.replace(" ", "_")}.jpg', 'ok', 1)
+        with open(fname, 'rb') as f:
+            assert f.read() == stub_server.IMAGE_BYTES
+
+    assert not [fname for fname in os.listdir(f'{cfg.output_directory}/images') if fname.endswith('.part')]
+
+def test_images_are_stored_as_blobs(people, monkeypatch, tmp_path):
+    monkeypatch.setattr(cfg, 'image_storage', 'blob')
+
+    image_retriever.get_images()
+
+    rows = image_rows()
+    assert all(rows[title][0].startswith(f'{cfg.output_directory}/images.db#') for title in PEOPLE)
+    assert not os.path.exists(f'{cfg.output_directory}/images')
+
+    image_retriever.export_images(tmp_path / 'exported')
+    exported = sorted(os.listdir(tmp_path / 'exported'))
+    assert exported == sorted(f'{title.replace(" ", "_")}.jpg' for title in PEOPLE)
+    with open(tmp_path / 'exported' / exported[0], 'rb') as f:
+        assert f.read() == stub_server.IMAGE_BYTES
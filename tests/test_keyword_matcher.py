@@ -0,0 +1,69 @@
+import random
+
+import db_wrapper
+import professions
+from keyword_matcher import KeywordMatcher
+
+def test_match_finds_overlapping_keywords():
+    matcher = KeywordMatcher([('actor', 'actor'), ('actress', 'actor'), ('tress', 'x'),
+                              ('voice actor', 'voice actor'), ('painter', 'artist')])
+
+    assert matcher.match('She was an ACTRESS.') == {'actor', 'x'}
+    assert matcher.match('a voice actor and painter') == {'actor', 'voice actor', 'artist'}
+    assert matcher.match('a contractor') == {'actor'}
+    assert matcher.match('a singer') == set()
+
+def test_match_folds_ascii_case_only():
+    matcher = KeywordMatcher([('émigré', 'emigrant'), ('Painter', 'artist')])
+
+    assert matcher.match('an Émigré PAINTER') == {'artist'}
+    assert matcher.match('an émigré') == {'emigrant'}
+
+# The professions LIKE '%keyword%' on the first 300 characters of each
+# summary gives, one query per keyword, as they were assigned before the
+# single pass tagger
+def like_professions(cur, keywords):
+    cur.execute('delete from people_to_profession')
+    for keyword, profession in keywords:
+        cur.execute('''
+            insert or ignore into people_to_profession
+            select title, ? from people
+            where substr(summary, 1, 300) like ?
+            ''', (profession, f'%{keyword}%'))
+
+    return set(cur.execute('select title, profession from people_to_profession'))
+
+def random_summary(rng, words):
+    summary = ' '.join(rng.choice(words) for _ in range(rng.randint(0, 80)))
+    # Mix up the case, including of non-ASCII letters
+    return ''.join(ch.upper() if rng.random() < 0.2 else ch for ch in summary)
+
+def test_tag_people_matches_like(db):
+    keywords, _ = professions.load_keywords()
+    # '%' and '_' are wildcards to LIKE
+    keywords = {(keyword, profession) for keyword, profession in keywords
+                if '%' not in keyword and '_' not in keyword}
+    keywords |= {('émigré', 'emigrant'), ('ß', 'other')}
+
+    rng = random.Random(7)
+    words = [keyword for keyword, _ in keywords] + \
+        ['was', 'an', 'American', 'born', 'in', 'Émigré', 'STRASSE', 'straße', '1950', '—']
+    people = [(f'Person {i}', 1950, 10, random_summary(rng, words)) for i in range(2000)]
+    # A keyword ending on the 300th character, and one cut off by it
+    people.append(('Last Actor', 1950, 10, 'x' * 295 + 'actor'))
+    people.append(('Late Actor', 1950, 10, 'x' * 296 + 'actor'))
+    people.append(('No Summary', 1950, 10, None))
+
+    with db_wrapper.DBManager() as cur:
+        cur.executemany('insert into people (title, birth_year, reference_count, summary) values (?, ?, ?, ?)',
+                        people)
+        expected = like_professions(cur, keywords)
+
+        cur.execute('delete from people_to_profession')
+        professions.tag_people(cur, keywords, '1')
+        tagged = set(cur.execute('select title, profession from people_to_profession'))
+
+    assert len(expected) > 2000
+    assert tagged == expected
+    assert ('Last Actor', 'actor') in tagged
+    assert ('Late Actor', 'actor') not in tagged
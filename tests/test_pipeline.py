@@ -0,0 +1,60 @@
+import queue
+import threading
+import time
+
+import pytest
+
+import db_wrapper
+import pipeline
+import scheduler
+import wiki_summary
+from config import cfg
+
+YEAR = 1950
+
+@pytest.fixture
+def streaming(wiki, monkeypatch):
+    monkeypatch.setattr(cfg, 'streaming_pipeline', True)
+    monkeypatch.setattr(cfg, 'crawl_prefilter', False)
+    monkeypatch.setattr(cfg, 'min_ref_count_for_summary', 10)
+    monkeypatch.setattr(cfg, 'summary_insert_batch_size', 200)
+
+    for i in range(120):
+        wiki.add_person(f'Person {i}', YEAR, ref_count=i)
+
+def people_count():
+    with db_wrapper.DBManager() as cur:
+        return cur.execute('select count(*) from people').fetchone()[0]
+
+def test_people_are_inserted_before_the_crawl_ends(streaming):
+    people = queue.Queue()
+    summarizer = threading.Thread(target=pipeline.summarize_stream, args=(people, YEAR))
+    summarizer.start()
+
+    # One crawl batch, far short of summary_insert_batch_size
+    people.put([(f'Person {i}', i, YEAR) for i in range(5, 15)])
+
+    deadline = time.monotonic() + 5
+    while people_count() < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    inserted = people_count()
+
+    people.put(None)
+    summarizer.join()
+    assert inserted == 5
+
+def test_streamed_year_is_not_summarized_twice(streaming, monkeypatch):
+    calls = []
+    insert_summaries_for_year = wiki_summary.insert_summaries_for_year
+    monkeypatch.setattr(wiki_summary, 'insert_summaries_for_year',
+                        lambda year: calls.append(year) or insert_summaries_for_year(year))
+    scheduler.queue_years(YEAR, YEAR)
+
+    scheduler.run_year_job(YEAR)
+    assert calls == []
+    assert people_count() == 110
+
+    # The file already exists, so the second run summarizes it from the file
+    scheduler.run_year_job(YEAR)
+    assert calls == [YEAR]
+    assert people_count() == 110
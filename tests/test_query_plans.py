@@ -0,0 +1,90 @@
+import sqlite3
+
+import pytest
+
+import db_wrapper
+from config import cfg
+
+# (query, parameters, a step of its plan on the original schema, the step
+# that replaces it once every migration has been applied)
+QUERIES = {
+    # professions.print_profession_members
+    'profession members': (
+        '''
+        select a.title, a.reference_count, a.birth_year
+        from people as a, people_to_profession as b
+        where a.title = b.title and b.profession = ?
+        order by a.reference_count desc
+        ''', ('actor',),
+        'SCAN b',
+        'SEARCH b USING COVERING INDEX people_to_profession_profession (profession=?)'),
+    # professions.print_profession_summary
+    'profession counts': (
+        '''
+        select profession, count(1) from people_to_profession
+        group by 1
+        order by 2 DESC
+        ''', (),
+        'USE TEMP B-TREE FOR GROUP BY',
+        'SCAN people_to_profession USING COVERING INDEX people_to_profession_profession'),
+    # image_retriever.get_images
+    'missing images': (
+        'select title from people where image_fname is null', (),
+        'SCAN people',
+        'SCAN people USING INDEX people_missing_image'),
+    # wiki_summary.insert_summaries_for_file
+    'people born in a year': (
+        'select title from people where birth_year = ?', (1950,),
+        'SCAN people',
+        'SEARCH people USING INDEX people_birth_year (birth_year=?)'),
+    'people above a reference count': (
+        'select title from people where reference_count >= ?', (60,),
+        'SCAN people',
+        'SEARCH people USING INDEX people_reference_count (reference_count>?)'),
+}
+
+def query_plan(conn, query, params):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+
+@pytest.fixture
+def original_schema(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, 'output_directory', str(tmp_path))
+    db_wrapper.close_connection()
+
+    conn = sqlite3.connect(tmp_path / 'people.db')
+    for statement in db_wrapper.MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.execute('PRAGMA user_version = 1')
+    conn.commit()
+
+    yield conn
+    conn.close()
+    db_wrapper.close_connection()
+
+@pytest.mark.parametrize('name', QUERIES)
+def test_query_plans_use_indexes(original_schema, name):
+    query, params, before, after = QUERIES[name]
+
+    plan = query_plan(original_schema, query, params)
+    assert before in plan
+    assert after not in plan
+
+    db_wrapper.initialize_tables()
+
+    plan = query_plan(db_wrapper.get_connection(), query, params)
+    assert before not in plan
+    assert after in plan
+
+def test_existing_database_is_upgraded_in_place(original_schema):
+    original_schema.execute("insert into people values ('Ada Lovelace', 1815, 40, 'A mathematician', NULL)")
+    original_schema.execute("insert into people_to_profession values ('Ada Lovelace', 'mathematician')")
+    original_schema.commit()
+
+    db_wrapper.initialize_tables()
+
+    with db_wrapper.DBManager() as cur:
+        assert cur.execute('PRAGMA user_version').fetchone()[0] == len(db_wrapper.MIGRATIONS)
+        assert cur.execute('select title, birth_year, reference_count, image_status from people').fetchall() == \
+            [('Ada Lovelace', 1815, 40, None)]
+        assert cur.execute("select title from people_fts where people_fts match 'mathematician'").fetchall() == \
+            [('Ada Lovelace',)]
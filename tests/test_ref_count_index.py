@@ -0,0 +1,32 @@
+import pytest
+
+import db_wrapper
+import ref_count_index
+from birth_year_binary import PeopleColumns
+
+@pytest.fixture
+def indexed(db):
+    ref_count_index.index_year(1950, PeopleColumns.from_rows([
+        ('A', 5, 1950, False), ('B', 50, 1950, False), ('C', 50, 1950, False),
+        ('D', 90, 1950, False), ('E', 200, 1950, True)]), 0)
+    ref_count_index.index_year(1957, PeopleColumns.from_rows([('F', 70, 1957, False)]), 0)
+    ref_count_index.index_year(-45, PeopleColumns.from_rows([('G', 10, -45, False)]), 0)
+
+def test_counts_at_thresholds_between_reference_counts(indexed, capsys):
+    ref_count_index.print_counts(40, by='year')
+    assert capsys.readouterr().out.splitlines() == [
+        'People with at least 40 references:',
+        '1950         3',
+        '1957         1',
+        'Total        4',
+        '1 more people might have, but their reference counts were only estimated',
+    ]
+
+    ref_count_index.print_counts(10)
+    assert capsys.readouterr().out.splitlines()[1:4] == ['40s BC       1', '1950s        4', 'Total        5']
+
+def test_threshold_is_looked_up_not_summed(indexed):
+    with db_wrapper.DBManager() as cur:
+        rows = cur.execute('select ref_count, people, at_least from ref_count_histogram '
+                           'where year = 1950 order by ref_count').fetchall()
+    assert rows == [(5, 1, 4), (50, 2, 3), (90, 1, 1)]
@@ -0,0 +1,19 @@
+import pytest
+
+import http_cache
+import image_store
+import rate_limiter
+import scheduler
+
+@pytest.mark.parametrize('workers, rate, concurrency', [(2, 5, 3), (8, 1.25, 1)])
+def test_workers_share_rate_and_concurrency_limits(db, monkeypatch, workers, rate, concurrency):
+    monkeypatch.setattr(rate_limiter, 'api', rate_limiter.RequestGate(10, 10, 6))
+    monkeypatch.setattr(http_cache, 'conn', None)
+    monkeypatch.setattr(image_store, 'conn', None)
+    monkeypatch.setattr(scheduler, 'inherited_connections', [])
+
+    scheduler.init_worker(workers)
+
+    assert rate_limiter.api.bucket.rate == rate
+    assert rate_limiter.api.concurrency.max_limit == concurrency
+    assert rate_limiter.api.concurrency.limit == concurrency
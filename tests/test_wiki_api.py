@@ -0,0 +1,63 @@
+import time
+
+import pytest
+import requests
+
+import metrics
+import rate_limiter
+import wiki_api
+from config import cfg
+
+@pytest.fixture
+def gate(wiki, monkeypatch):
+    wiki.add_person('Ada Lovelace', 1815, ref_count=40)
+
+    monkeypatch.setattr(cfg, 'max_retries', 2)
+    monkeypatch.setattr(cfg, 'retry_base_seconds', 0.01)
+    monkeypatch.setattr(cfg, 'retry_max_seconds', 0.02)
+    monkeypatch.setattr(cfg, 'request_timeout', 0.2)
+    # get_with_retries uses rate_limiter.api by default
+    monkeypatch.setattr(rate_limiter.api, 'bucket', rate_limiter.TokenBucket(0, 1))
+    monkeypatch.setattr(rate_limiter.api, 'concurrency', rate_limiter.AdaptiveConcurrency(4))
+    return rate_limiter.api
+
+def retries():
+    return sum(metrics.counter_values('http_retries', 'endpoint').values())
+
+def test_429_waits_for_retry_after(wiki, gate):
+    wiki.fail_next(status=429, retry_after=0.3)
+    before = retries()
+
+    start = time.monotonic()
+    titles, _ = wiki_api.get_category_members('Category:1815_births')
+
+    assert titles == ['Ada Lovelace']
+    assert time.monotonic() - start >= 0.3
+    assert retries() == before + 1
+    # Halved, then raised a little by the request that succeeded
+    assert gate.concurrency.limit == 2.5
+
+def test_timeout_is_retried_as_overload(wiki, gate):
+    wiki.fail_next(delay=0.5)
+
+    titles, _ = wiki_api.get_category_members('Category:1815_births')
+
+    assert titles == ['Ada Lovelace']
+    # Halved, then raised a little by the request that succeeded
+    assert gate.concurrency.limit == 2.5
+
+def test_timeouts_raise_once_retries_are_used_up(wiki, gate):
+    for _ in range(cfg.max_retries + 1):
+        wiki.fail_next(delay=0.5)
+
+    with pytest.raises(requests.Timeout):
+        wiki_api.get_category_members('Category:1815_births')
+    assert gate.concurrency.limit == 1
+    assert gate.concurrency.in_flight == 0
+
+def test_streamed_response_holds_its_slot_until_read(wiki, gate):
+    with wiki_api.stream_with_retries(wiki_api.session, wiki.image_url('Ada Lovelace')) as response:
+        assert gate.concurrency.in_flight == 1
+        assert response.content.startswith(b'\xff\xd8')
+
+    assert gate.concurrency.in_flight == 0
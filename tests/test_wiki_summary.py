@@ -0,0 +1,49 @@
+import db_wrapper
+import metrics
+import professions
+import wiki_api
+import wiki_summary
+
+def test_renamed_person_is_tagged_again(db):
+    with db_wrapper.DBManager() as cur:
+        cur.execute("insert into people (title, birth_year, reference_count, summary) "
+                    "values ('Old Title', 1950, 100, 'Someone was an American actor.')")
+    professions.update_professions()
+
+    with db_wrapper.DBManager() as cur:
+        # The summary is not fetched again, as when the request fails
+        refetch, merged = wiki_summary.merge_redirects(cur, {'Old Title': 'New Title'})
+        assert (refetch, merged) == (['New Title'], 0)
+        assert list(professions.get_professions('New Title')) == []
+
+    professions.update_professions()
+
+    assert list(professions.get_professions('New Title')) == ['actor']
+
+def test_refresh_skips_batches_whose_revisions_cannot_be_fetched(wiki, monkeypatch):
+    titles = [f'Person {i}' for i in range(wiki_api.MAX_TITLES_PER_REQUEST + 1)]
+    for title in titles:
+        wiki.add_person(title, 1950, ref_count=60, extract=f'{title} was a poet.')
+
+    with db_wrapper.DBManager() as cur:
+        cur.executemany("insert into people (title, birth_year, reference_count, summary, pageid, lastrevid) "
+                        "values (?, 1950, 60, 'Outdated.', ?, 0)",
+                        [(title, wiki.pages[title].pageid) for title in titles])
+
+    get_latest_revisions = wiki_api.get_latest_revisions
+    calls = []
+    def fail_first_batch(pageids):
+        calls.append(pageids)
+        if len(calls) == 1:
+            raise wiki_api.ApiError('maxlag', 'Waiting for a database server')
+        return get_latest_revisions(pageids)
+    monkeypatch.setattr(wiki_api, 'get_latest_revisions', fail_first_batch)
+    skipped = metrics.counter_values('skipped_rows', 'stage').get('refresh', 0)
+
+    wiki_summary.refresh_people()
+
+    assert len(calls) == 2
+    assert metrics.counter_values('skipped_rows', 'stage')['refresh'] - skipped == len(titles) - 1
+    with db_wrapper.DBManager() as cur:
+        assert cur.execute("select title from people where summary != 'Outdated.'").fetchall() == \
+            [(titles[-1],)]
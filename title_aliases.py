@@ -0,0 +1,72 @@
+# Every title we have seen, mapped to the page it ends up at.
+#
+# Category members, birth year files and old rows in the people table can
+# name a page by a title that redirects to it, and the same person can be
+# listed under different titles in different birth year categories.  The
+# crawl, summary and image stages look titles up here before fetching, so
+# each page is fetched and stored once, under its canonical title.
+#
+# Pages fetched with wiki_api.get_page_infos are recorded as they are
+# fetched.  Other titles are resolved in batches with resolve().
+
+import time
+
+import db_wrapper
+import wiki_api
+
+# Returns a dict of title -> (canonical title, pageid) for the 'titles'
+# already in the table
+def lookup(titles):
+    known = {}
+    chunk_size = 500
+
+    with db_wrapper.DBManager() as cur:
+        for start in range(0, len(titles), chunk_size):
+            chunk = titles[start:start + chunk_size]
+            marks = ','.join('?' * len(chunk))
+            query = f'select alias, title, pageid from title_aliases where alias in ({marks})'
+            for alias, title, pageid in cur.execute(query, chunk):
+                known[alias] = (title, pageid)
+
+    return known
+
+# Returns a dict of title -> canonical title for all of 'titles'.  Titles
+# that aren't known map to themselves.
+def canonical_titles(titles):
+    known = lookup(titles)
+    return {title: known[title][0] if title in known else title for title in titles}
+
+# 'infos' is a dict of title -> wiki_api.PageInfo.  Records the page each
+# title ended up at.  Pages that don't exist are not recorded, since they
+# may be created later.
+def record(infos):
+    now = time.time()
+    rows = []
+
+    for title, info in infos.items():
+        if info.pageid is not None:
+            rows.append((title, info.title, info.pageid, now))
+            rows.append((info.title, info.title, info.pageid, now))
+
+    store(rows)
+
+# Returns a dict of title -> (canonical title, pageid) for all of 'titles',
+# asking the API about the ones that aren't known yet.  pageid is None for
+# pages that don't exist.
+def resolve(titles):
+    known = lookup(titles)
+
+    unknown = [title for title in titles if title not in known]
+    if unknown:
+        resolved = wiki_api.resolve_titles(unknown)
+
+        now = time.time()
+        store([(alias, title, pageid, now) for alias, (title, pageid) in resolved.items()
+               if pageid is not None])
+        known.update(resolved)
+
+    return {title: known[title] for title in titles}
+
+def store(rows):
+    with db_wrapper.DBManager() as cur:
+        cur.executemany('insert or replace into title_aliases values (?, ?, ?, ?)', rows)
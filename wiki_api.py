@@ -0,0 +1,362 @@
+# A small client for the MediaWiki action API.
+#
+# Everything we need to know about a person -- reference count, summary
+# and lead image -- is fetched with a single query covering up to 50 titles,
+# rather than one request per title and stage.  The endpoint is
+# configurable (api_url in config.yaml) so the client can be pointed at a
+# local fake API server.
+#
+# The reference count is the number of external links on the page, which is
+# what the 'wikipedia' module's page.references returned.
+#
+# Redirects are followed, so a title that redirects gets the information of
+# the page it redirects to, along with that page's canonical title and id.
+# Redirects to a section of another page are not followed: they usually
+# lead to an article about something else, e.g. a band the person was in,
+# so they are reported as 'redirect' errors under their own title.
+#
+# Requests that fail because of a network error or because the server is
+# overloaded (429, 5xx, or MediaWiki's maxlag) are retried with jittered
+# exponential backoff, waiting at least as long as any Retry-After says.
+
+import logging
+import random
+import time
+from collections import namedtuple
+from contextlib import contextmanager, ExitStack
+from urllib.parse import urlsplit
+
+import requests
+
+import http_cache
+import metrics
+import rate_limiter
+from config import cfg
+
+log = logging.getLogger(__name__)
+
+# MediaWiki's limit on the number of titles in one query for normal clients
+MAX_TITLES_PER_REQUEST = 50
+
+# error is None for a normal page, otherwise 'redirect' (for a redirect
+# that couldn't be followed) or 'missing'.  title, pageid and revid (its
+# latest revision) are those of the page the title ends up at, and None if
+# it is missing.
+PageInfo = namedtuple('PageInfo', ['ref_count', 'summary', 'image_url', 'error', 'title', 'pageid',
+                                   'revid'])
+
+# The canonical title, id and length in bytes of a page, all None if it
+# is missing
+PageSize = namedtuple('PageSize', ['title', 'pageid', 'length'])
+
+class ApiError(Exception):
+    def __init__(self, code, info):
+        super().__init__(f'{code}: {info}')
+        self.code = code
+        self.info = info
+
+session = requests.Session()
+session.headers.update(
+    {
+        'User-Agent': f'WikiPeopleGetterTestBot/0.1 ({cfg.email})'
+    }
+)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def api_get(params):
+    params = dict(params, format='json', formatversion=2, maxlag=cfg.maxlag)
+
+    response = get_with_retries(session, cfg.api_url, params=params)
+    response.raise_for_status()
+    result = response.json()
+
+    if 'error' in result:
+        raise ApiError(result['error'].get('code'), result['error'].get('info'))
+
+    return result
+
+# GETs 'url' with the requests session 'http' through the RequestGate
+# 'gate', retrying up to max_retries times.  Returns the response, which
+# may still have an unsuccessful status if retrying wouldn't help.  Raises
+# the last error once the retries are used up.
+def get_with_retries(http, url, gate=rate_limiter.api, **kwargs):
+    response, slot, _ = send_with_retries(http, url, gate, **kwargs)
+    slot.close()
+    return response
+
+# Like get_with_retries, but streams the response, which is yielded with
+# its slot in the gate still held.  Reading the body then counts against
+# the concurrency limit, and a network error while reading it counts as a
+# sign of overload.
+@contextmanager
+def stream_with_retries(http, url, gate=rate_limiter.api, **kwargs):
+    response, slot, outcome = send_with_retries(http, url, gate, stream=True, **kwargs)
+
+    with slot, response:
+        try:
+            yield response
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            outcome.overloaded = True
+            raise
+
+# Returns (response, the ExitStack holding its slot in the gate, the
+# slot's outcome).  Closing the ExitStack releases the slot.
+def send_with_retries(http, url, gate, **kwargs):
+    endpoint = endpoint_name(url, kwargs.get('params'))
+
+    for attempt in range(cfg.max_retries + 1):
+        retry_after = None
+
+        try:
+            with ExitStack() as slot:
+                outcome = slot.enter_context(gate.slot())
+                try:
+                    with metrics.timer('http_request_seconds', endpoint=endpoint):
+                        response = http.get(url, timeout=cfg.request_timeout, **kwargs)
+                except (requests.ConnectionError, requests.Timeout):
+                    # Timeouts are the usual sign of an overloaded server
+                    outcome.overloaded = True
+                    metrics.increment('http_responses', endpoint=endpoint, status='error')
+                    raise
+                metrics.increment('http_responses', endpoint=endpoint,
+                                  status=response.status_code)
+
+                maxlag = response.headers.get('MediaWiki-API-Error') == 'maxlag'
+                if response.status_code not in RETRY_STATUSES and not maxlag:
+                    return response, slot.pop_all(), outcome
+
+                outcome.overloaded = True
+                retry_after = parse_retry_after(response)
+                error = requests.HTTPError(
+                    f'{"maxlag" if maxlag else response.status_code} for {url}', response=response)
+                response.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+
+        if attempt == cfg.max_retries:
+            raise error
+
+        delay = backoff_delay(attempt)
+        if retry_after is not None:
+            # Everyone sharing the gate waits, not just this request
+            gate.bucket.pause(retry_after)
+            delay = max(delay, retry_after)
+
+        metrics.increment('http_retries', endpoint=endpoint)
+        log.warning(f'Retrying in {delay:.1f}s after {error!r}')
+        time.sleep(delay)
+
+# Returns a short name for the kind of request, to group request metrics
+# by: the API action and list or prop, e.g. 'query:categorymembers', or
+# the host for anything else, e.g. image downloads
+def endpoint_name(url, params):
+    if params and 'action' in params:
+        detail = params.get('list') or params.get('prop')
+        return f"{params['action']}:{detail}" if detail else params['action']
+
+    return urlsplit(url).hostname or url
+
+# Exponential backoff with full jitter
+def backoff_delay(attempt):
+    ceiling = min(cfg.retry_max_seconds, cfg.retry_base_seconds * 2 ** attempt)
+    return random.uniform(ceiling / 2, ceiling)
+
+# Returns the number of seconds in the response's Retry-After header, or None
+def parse_retry_after(response):
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+# Generator which yields each result of a query, following the API's
+# 'continue' tokens until the query is complete.
+def query_continued(params):
+    cont = {}
+    while True:
+        result = api_get(dict(params, **cont))
+        yield result.get('query', {})
+
+        if 'continue' not in result:
+            break
+        cont = result['continue']
+
+# Returns a dict of title -> PageInfo for all of 'titles', making one
+# request (plus continuations) per MAX_TITLES_PER_REQUEST titles.
+# Titles found in the response cache are not requested again.
+def get_page_infos(titles):
+    titles = list(dict.fromkeys(titles))
+
+    cached = http_cache.get_many('page_info', titles)
+    infos = {title: PageInfo(*value) for title, value in cached.items()}
+
+    missing = [title for title in titles if title not in infos]
+    for start in range(0, len(missing), MAX_TITLES_PER_REQUEST):
+        fetched = fetch_batch(missing[start:start + MAX_TITLES_PER_REQUEST])
+        http_cache.put_many('page_info', fetched)
+        infos.update(fetched)
+
+    return infos
+
+def fetch_batch(titles):
+    params = {
+        'action': 'query',
+        'titles': '|'.join(titles),
+        'redirects': 1,
+        'prop': 'info|extracts|extlinks|pageimages',
+        'exintro': 1,
+        'explaintext': 1,
+        'exlimit': 'max',
+        'ellimit': 'max',
+        'piprop': 'thumbnail',
+        'pithumbsize': cfg.image_max_dimension,
+        'pilimit': 'max',
+    }
+
+    pages = {}
+    normalized = {}
+    redirects = {}
+    section_redirects = set()
+
+    for query in query_continued(params):
+        for n in query.get('normalized', []):
+            normalized[n['from']] = n['to']
+        for r in query.get('redirects', []):
+            redirects[r['from']] = r['to']
+            if r.get('tofragment'):
+                section_redirects.add(r['from'])
+
+        # Titles that normalize to the same page may list it more than once
+        seen = set()
+        for page in query.get('pages', []):
+            if page['title'] in seen:
+                continue
+            seen.add(page['title'])
+
+            merged = pages.setdefault(page['title'], {})
+            for key, value in page.items():
+                # extlinks are split across continuations; everything else
+                # arrives in one piece
+                if key == 'extlinks':
+                    merged.setdefault(key, []).extend(value)
+                else:
+                    merged[key] = value
+
+    infos = {}
+    for title in titles:
+        name = normalized.get(title, title)
+        if name in section_redirects:
+            infos[title] = PageInfo(0, '', None, 'redirect', name, None, None)
+            continue
+
+        page = pages.get(redirects.get(name, name), {'missing': True})
+        infos[title] = to_page_info(page)
+
+    return infos
+
+def to_page_info(page):
+    if page.get('missing') or page.get('invalid'):
+        return PageInfo(0, '', None, 'missing', None, None, None)
+
+    if page.get('redirect'):
+        return PageInfo(0, '', None, 'redirect', page['title'], page.get('pageid'),
+                        page.get('lastrevid'))
+
+    image_url = page.get('thumbnail', {}).get('source')
+    return PageInfo(len(page.get('extlinks', [])), page.get('extract', ''), image_url, None,
+                    page['title'], page.get('pageid'), page.get('lastrevid'))
+
+# Returns a dict of title -> (canonical title, pageid) of the page it ends
+# up at, after normalization and following redirects.  Titles that don't
+# redirect map to themselves; pageid is None if the page doesn't exist.
+def resolve_titles(titles):
+    resolved = {}
+
+    for title, size in get_page_sizes(titles).items():
+        resolved[title] = (size.title or title, size.pageid)
+
+    return resolved
+
+# Returns a dict of pageid -> (title, latest revision id) for the pages in
+# 'pageids' that still exist.  Always asks the API, never the cache.
+def get_latest_revisions(pageids):
+    revisions = {}
+
+    for start in range(0, len(pageids), MAX_TITLES_PER_REQUEST):
+        batch = pageids[start:start + MAX_TITLES_PER_REQUEST]
+        result = api_get({'action': 'query', 'pageids': '|'.join(map(str, batch)), 'prop': 'info'})
+
+        for page in result.get('query', {}).get('pages', []):
+            if not page.get('missing') and not page.get('invalid'):
+                revisions[page['pageid']] = (page['title'], page.get('lastrevid'))
+
+    return revisions
+
+# Returns a dict of title -> PageSize, following redirects.  This only asks
+# for page metadata, so it is much cheaper than get_page_infos.  A redirect
+# to a section of another page is not followed; it gets its own title, with
+# no page id or length.
+def get_page_sizes(titles):
+    titles = list(dict.fromkeys(titles))
+
+    cached = http_cache.get_many('page_size', titles)
+    sizes = {title: PageSize(*value) for title, value in cached.items()}
+
+    missing = [title for title in titles if title not in sizes]
+    for start in range(0, len(missing), MAX_TITLES_PER_REQUEST):
+        batch = missing[start:start + MAX_TITLES_PER_REQUEST]
+        result = api_get({'action': 'query', 'titles': '|'.join(batch), 'redirects': 1,
+                          'prop': 'info'})
+
+        query = result.get('query', {})
+        normalized = {n['from']: n['to'] for n in query.get('normalized', [])}
+        redirects = {r['from']: r['to'] for r in query.get('redirects', [])
+                     if not r.get('tofragment')}
+        section_redirects = {r['from'] for r in query.get('redirects', []) if r.get('tofragment')}
+        pages = {page['title']: page for page in query.get('pages', [])
+                 if not page.get('missing') and not page.get('invalid')}
+
+        fetched = {}
+        for title in batch:
+            name = normalized.get(title, title)
+            if name in section_redirects:
+                fetched[title] = PageSize(name, None, None)
+                continue
+
+            page = pages.get(redirects.get(name, name))
+            if page:
+                fetched[title] = PageSize(page['title'], page.get('pageid'), page.get('length'))
+            else:
+                fetched[title] = PageSize(None, None, None)
+
+        http_cache.put_many('page_size', fetched)
+        sizes.update(fetched)
+
+    return sizes
+
+# Returns (titles, continuation) for one page of a category's members.
+# Pass the continuation back in to get the next page; it is None after the
+# last page.
+def get_category_members(category, cont=None):
+    params = {'action': 'query', 'list': 'categorymembers', 'cmtitle': category, 'cmlimit': 'max'}
+    result = api_get(dict(params, **(cont or {})))
+
+    titles = [m['title'] for m in result.get('query', {}).get('categorymembers', [])]
+    return titles, result.get('continue')
+
+# Returns the rendered HTML of the page, or of just one section of it.
+# Section 0 is the lead section, which holds the infobox.
+def get_html(title, section=None):
+    params = {'action': 'parse', 'page': title, 'prop': 'text', 'redirects': 1}
+    kind = 'html'
+    if section is not None:
+        params['section'] = section
+        kind = f'html_section_{section}'
+
+    html = http_cache.get(kind, title)
+    if html is None:
+        result = api_get(params)
+        html = result['parse']['text']
+        http_cache.put(kind, title, html)
+
+    return html
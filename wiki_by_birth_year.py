@@ -3,82 +3,220 @@
 # of all humans born in that year who have a page on wikipedia.
 #
 # Once a birth year file is obtained it can later be iterated through using
-# 'iterate_birth_year_file'
+# 'iterate_birth_year_file', or loaded in columns with 'load_people_columns'.
 
-import sys
 import os
 import re
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-# Two 3rd party wikipedia modules are used, based on unique functionality.
-
-# This module is capable of retrieving all members in a wikipedia
-# category.  This is useful because for each year in history,
-# wikipedia defines a category for humans born in that year.
-import wikipediaapi
-
-# This module is capable of retrieving the list of references
-# for a wiki page.  Reference count on a page is a simple first
-# metric to filter out likely unimportant historical figures.
-import wikipedia
+# For each year in history, wikipedia defines a category for humans born
+# in that year.  The category's members and their reference counts are
+# fetched with the batched API client.  Reference count on a page is a
+# simple first metric to filter out likely unimportant historical figures.
+#
+# With crawl_prefilter set, the length of each page is fetched first, and
+# pages too short to possibly have min_ref_count_for_summary references are
+# not counted.  They are written with an estimated upper bound instead,
+# marked with a '~': '~<max ref_count> <year> |<title>'.
+import wiki_api
+import birth_year_binary
+import db_wrapper
+import metrics
+import ref_count_index
+import title_aliases
 
 from config import cfg 
 
-wikipediaapi.log.setLevel(level=wikipediaapi.logging.DEBUG)
-out_hdlr = wikipediaapi.logging.StreamHandler(sys.stderr)
-out_hdlr.setFormatter(wikipediaapi.logging.Formatter('%(asctime)s %(message)s'))
-out_hdlr.setLevel(wikipediaapi.logging.DEBUG)
-wikipediaapi.log.addHandler(out_hdlr)
-
-wiki_wiki = wikipediaapi.Wikipedia('en')
+log = logging.getLogger(__name__)
 
-def write_birth_year_file(year):
+# The file is written as <fname>.part and only renamed to <fname> once the
+# whole category has been crawled.  After each page of category members,
+# the API's continuation for the next page is saved in <fname>.checkpoint,
+# so an interrupted crawl resumes from the last page instead of starting
+# over, skipping the members already in the .part file.
+#
+# If 'on_members' is given, it is called with a list of (title, ref_count,
+# year) for each batch of members as soon as they are written.  Returns
+# True if every member was crawled, and passed to on_members, by this call,
+# and False if the file already existed or an earlier crawl was resumed.
+def write_birth_year_file(year, on_members=None):
     page_name = year_to_category_name(year)
     fname = year_to_filename(year)
 
     if os.path.exists(fname):
         print(f'Birth year file {fname} already exists; not regenerating it')
-        return
+        return False
 
     os.makedirs(os.path.dirname(fname), exist_ok=True)
 
-    with open(fname, 'w', encoding='utf-8') as myfile:
+    part_fname = fname + '.part'
+    checkpoint_fname = fname + '.checkpoint'
+    done_titles, cont = load_checkpoint(part_fname, checkpoint_fname)
+
+    resumed_from = len(done_titles)
+    if resumed_from:
+        print(f'Resuming crawl of {page_name}; {resumed_from} members already counted')
+
+    with open(part_fname, 'a', encoding='utf-8') as myfile, \
+         ThreadPoolExecutor(max_workers=cfg.max_concurrent_requests) as executor, \
+         metrics.timer('stage_seconds', stage='crawl'):
         print(f"Getting category '{page_name}' and writing results to {fname}")
 
-        cat = wiki_wiki.page(page_name)
+        while True:
+            titles, cont = wiki_api.get_category_members(page_name, cont)
+            titles = [title for title in titles if title not in done_titles]
+            write_members(executor, titles, year, myfile, done_titles, on_members)
+
+            if cont is None:
+                break
+            save_checkpoint(checkpoint_fname, cont)
 
-        counter = 0
-        for c in cat.categorymembers.values():
-            write_member(c.title, year, counter, myfile)
-            counter = counter + 1
+    os.replace(part_fname, fname)
+    if os.path.exists(checkpoint_fname):
+        os.remove(checkpoint_fname)
+
+    if cfg.birth_year_binary_files:
+        convert_people_file(fname)
+
+    index_birth_year_file(year)
 
     print("Done")
+    return resumed_from == 0
+
+# Reference counts are fetched concurrently, one batch of titles per
+# request, but written in category order, so the file is identical to one
+# produced serially.
+#
+# Each member is written under the canonical title of their page, once,
+# even if the category lists them under several titles.  Titles already
+# known to redirect are looked up in title_aliases before fetching.
+# 'done_titles' is the set of titles already written and is updated.
+def write_members(executor, titles, year, myfile, done_titles, on_members=None):
+    canonical = title_aliases.canonical_titles(titles)
+    titles = list(dict.fromkeys(canonical[title] for title in titles))
+    titles = [title for title in titles if title not in done_titles]
+
+    batch_size = wiki_api.MAX_TITLES_PER_REQUEST
+    batches = [titles[i:i + batch_size] for i in range(0, len(titles), batch_size)]
+
+    for batch, counted in zip(batches, executor.map(count_members, batches)):
+        title_aliases.record({title: info for title, (info, _) in zip(batch, counted)})
+        written = []
+
+        for title, (info, estimated) in zip(batch, counted):
+            title = info.title or title
+            if title in done_titles:
+                continue
+
+            done_titles.add(title)
+            write_member(title, year, info.ref_count, myfile, estimated)
+            metrics.increment('rows', stage='crawl')
+            if not estimated:
+                written.append((title, info.ref_count, year))
+
+        if on_members:
+            on_members(written)
+
+    myfile.flush()
+    os.fsync(myfile.fileno())
+
+# Returns the set of titles already written to the .part file and the
+# continuation to resume the category listing from (None to start at the
+# beginning).  A partly written last line is discarded.
+def load_checkpoint(part_fname, checkpoint_fname):
+    done_titles = set()
+    cont = None
+
+    if os.path.exists(part_fname):
+        with open(part_fname, 'r+', encoding='utf-8', newline='') as part:
+            text = part.read()
+            complete = text[:text.rfind('\n') + 1]
+            if len(complete) != len(text):
+                part.seek(0)
+                part.write(complete)
+                part.truncate()
+
+        for line in complete.splitlines():
+            done_titles.add(line.partition('|')[2])
+
+    if os.path.exists(checkpoint_fname):
+        with open(checkpoint_fname, 'r', encoding='utf-8') as checkpoint:
+            cont = json.load(checkpoint)
+
+    return done_titles, cont
+
+def save_checkpoint(checkpoint_fname, cont):
+    tmp_fname = checkpoint_fname + '.tmp'
+    with open(tmp_fname, 'w', encoding='utf-8') as checkpoint:
+        json.dump(cont, checkpoint)
+    os.replace(tmp_fname, checkpoint_fname)
+
+# Returns (wiki_api.PageInfo, estimated) for each of 'titles'.  Runs on a
+# worker thread.  Request failures are raised, leaving the crawl to be
+# resumed later, rather than silently dropping the titles.
+def count_members(titles):
+    log.debug(f'About to work on {len(titles)} members starting with {titles[0]}')
+
+    counted = {}
+    if cfg.crawl_prefilter:
+        counted = prefilter_members(titles)
+
+    infos = wiki_api.get_page_infos([title for title in titles if title not in counted])
+    counted.update((title, (info, False)) for title, info in infos.items())
+
+    for title in titles:
+        if counted[title][0].error == 'missing':
+            log.debug(f'Skipping title ${title} because of PageError')
+
+    return [counted[title] for title in titles]
+
+# Returns a dict of title -> (wiki_api.PageInfo, estimated) for the 'titles'
+# that don't need their references counted: pages that are missing or
+# redirect to a section of another page, and pages too short to have min_ref_count_for_summary references, whose
+# ref_count is an upper bound.  The bound is generous, since templates can
+# add several links in a few bytes.
+def prefilter_members(titles):
+    counted = {}
+
+    for title, size in wiki_api.get_page_sizes(titles).items():
+        if size.length is None:
+            error = 'missing' if size.title is None else 'redirect'
+            counted[title] = (wiki_api.PageInfo(0, '', None, error, size.title, None, None), False)
+            continue
 
-def write_member(title, birth_year, counter, myfile):
-    try:
-        utf8_title = title.encode("utf-8")
-        print(f'About to work on member {counter} {title}')
-        sys.stdout.flush()
-        ref_count = get_reference_count(title)
+        bound = size.length // cfg.prefilter_bytes_per_reference + cfg.prefilter_reference_allowance
+        if bound < cfg.min_ref_count_for_summary:
+            info = wiki_api.PageInfo(bound, '', None, None, size.title, size.pageid, None)
+            counted[title] = (info, True)
 
-        myfile.write(f'{ref_count} {birth_year} |{title}\n')
-        myfile.flush()
-    except UnicodeEncodeError:
-        print("UnicodeEncodeError")
-    except KeyError:
-        print("Skipping due to KeyError")
+    estimated = sum(estimated for _, estimated in counted.values())
+    if estimated:
+        print(f'Estimated the reference counts of {estimated} short pages')
+
+    return counted
+
+def write_member(title, birth_year, ref_count, myfile, estimated=False):
+    marker = '~' if estimated else ''
+    myfile.write(f'{marker}{ref_count} {birth_year} |{title}\n')
+
+# Returns a dict of title -> reference count
+def get_reference_counts(titles):
+    ref_counts = {}
+
+    for title, info in wiki_api.get_page_infos(titles).items():
+        if info.error == 'redirect':
+            log.debug(f'Skipping title ${title} because it will redirect')
+        elif info.error == 'missing':
+            log.debug(f'Skipping title ${title} because of PageError')
+
+        ref_counts[title] = info.ref_count
+
+    return ref_counts
 
 def get_reference_count(title):
-    ref_count = 0
-    try:
-        page = wikipedia.page(title, pageid=None, auto_suggest=False,
-                              redirect=False, preload=False)
-        ref_count = len(page.references)
-    except wikipedia.exceptions.RedirectError:
-        print(f'Skipping title ${title} because it will redirect')
-    except wikipedia.exceptions.PageError:
-        print(f'Skipping title ${title} because of PageError')
-
-    return ref_count
+    return get_reference_counts([title])[title]
 
 def year_to_category_name(year):
     # Wikipedia has categories for all the people born in each year of history.
@@ -125,29 +263,137 @@ def year_to_filename(year):
 
     return f'{cfg.output_directory}/birth_year_files/{prefix}{year}_births'
 
-# Generator which yields tuples of (page title, ref_count, year)
-# for all items in fname.
+# Generator which yields tuples of (page title, ref_count, year, estimated)
+# for all items in fname.  For estimated items ref_count is an upper bound.
 def iterate_people_file(fname):
-    pattern = re.compile('(\d+) -?(\d+) \|(.+)')
+    pattern = re.compile(r'(~?)(\d+) (-?\d+) \|(.+)')
 
     with open(fname, 'r', encoding='utf-8') as myfile:
         for line in myfile:
-            line.rstrip()
+            line = line.rstrip('\n')
             match = pattern.match(line)
             if match:
-                ref_count = int(match.group(1))
-                year = int(match.group(2))
-                title = match.group(3)
-                yield (title, ref_count, year)
+                estimated = match.group(1) == '~'
+                ref_count = int(match.group(2))
+                year = int(match.group(3))
+                title = match.group(4)
+                yield (title, ref_count, year, estimated)
             else:
                 print(f'ERROR: Line {line} is not in the correct format')
 
-# Generator which yields tuples of (page title, ref_count, year)
+# Birth year files of BC years used to be read without the minus sign, so
+# the people inserted from them have positive birth years.  Negates the
+# birth year of everyone listed in a bc_ file who still has the positive
+# year.  Runs once per database.
+def repair_bc_birth_years():
+    with db_wrapper.DBManager() as cur:
+        if db_wrapper.get_state(cur, 'bc_birth_years_repaired'):
+            return
+
+    directory = os.path.dirname(year_to_filename(-1))
+    pattern = re.compile(r'bc_(\d+)_births(\.bin)?')
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    years = sorted({int(match.group(1)) for match in map(pattern.fullmatch, names) if match})
+
+    repaired = 0
+    with db_wrapper.Transaction() as cur:
+        for year in years:
+            people = load_people_columns(year_to_filename(-year))
+            cur.executemany("update people set birth_year = ? where title = ? and birth_year = ?",
+                            ((-year, title, year) for title, _, _, _ in people))
+            repaired += cur.rowcount
+
+        db_wrapper.set_state(cur, 'bc_birth_years_repaired', '1')
+
+    if repaired:
+        print(f'Fixed the birth year of {repaired} people born BC')
+
+# Generator which yields tuples of (page title, ref_count, year, estimated)
 # for all items previously downloaded in the 'year' file.
 def iterate_birth_year_file(year):
     fname = year_to_filename(year)
     yield from iterate_people_file(fname)
 
+# Loads all people in fname as birth_year_binary.PeopleColumns, from the
+# binary copy <fname>.bin if it is up to date and from the text file
+# otherwise.
+def load_people_columns(fname):
+    bin_fname = fname + '.bin'
+
+    if os.path.exists(bin_fname) and (not os.path.exists(fname) or
+                                      os.path.getmtime(bin_fname) >= os.path.getmtime(fname)):
+        return birth_year_binary.read_file(bin_fname)
+
+    return birth_year_binary.PeopleColumns.from_rows(iterate_people_file(fname))
+
+def have_people_file(fname):
+    return os.path.exists(fname) or os.path.exists(fname + '.bin')
+
+# Writes the binary copy <fname>.bin of a text people file
+def convert_people_file(fname):
+    columns = birth_year_binary.PeopleColumns.from_rows(iterate_people_file(fname))
+    birth_year_binary.write_file(fname + '.bin', columns)
+    return len(columns)
+
+# Writes a binary copy of every birth year file that doesn't have an up to
+# date one yet
+def convert_birth_year_files():
+    directory = f'{cfg.output_directory}/birth_year_files'
+    converted = 0
+
+    for name in sorted(os.listdir(directory)):
+        fname = os.path.join(directory, name)
+        bin_fname = fname + '.bin'
+
+        if not name.endswith('_births'):
+            continue
+        if os.path.exists(bin_fname) and os.path.getmtime(bin_fname) >= os.path.getmtime(fname):
+            continue
+
+        count = convert_people_file(fname)
+        print(f'Converted {fname} ({count} people)')
+        converted += 1
+
+    print(f'Converted {converted} birth year files')
+
+# Adds the people in the birth year file for 'year' to the global
+# reference count index
+def index_birth_year_file(year):
+    fname = year_to_filename(year)
+    columns = load_people_columns(fname)
+    ref_count_index.index_year(year, columns, os.path.getmtime(fname))
+    return len(columns)
+
+# Indexes every birth year file that has changed since it was last indexed
+def index_birth_year_files():
+    directory = f'{cfg.output_directory}/birth_year_files'
+    indexed = 0
+
+    for name in sorted(os.listdir(directory)):
+        year = filename_to_year(name)
+        if year is None:
+            continue
+
+        mtime = os.path.getmtime(os.path.join(directory, name))
+        if ref_count_index.indexed_mtime(year) == mtime:
+            continue
+
+        count = index_birth_year_file(year)
+        print(f'Indexed {name} ({count} people)')
+        indexed += 1
+
+    print(f'Indexed {indexed} birth year files')
+
+# The inverse of the file name part of year_to_filename.  Returns None for
+# names that aren't birth year files.
+def filename_to_year(name):
+    match = re.fullmatch(r'(bc_)?(\d+)_births', name)
+    if not match:
+        return None
+
+    year = int(match.group(2))
+    return -year if match.group(1) else year
+
 def have_birth_year_file(year):
     fname = year_to_filename(year)
     return os.path.exists(fname)
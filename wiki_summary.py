@@ -1,64 +1,334 @@
-import wikipedia
+import wiki_api
 import wiki_by_birth_year
 import db_wrapper
+import http_cache
+import metrics
 import professions
-import sys
-import os
+import title_aliases
+import logging
+import requests
+from collections import namedtuple
 
 from config import cfg 
 
+log = logging.getLogger(__name__)
+
+# status is 'ok', 'redirect', 'missing' or 'error'.  error is the class of
+# the error for anything but 'ok'.  Redirects and errors are retried by
+# --retry-failed.  title, pageid and revid are the canonical title, id and
+# latest revision of the page, when known.
+SummaryResult = namedtuple('SummaryResult', ['summary', 'status', 'error', 'title', 'pageid',
+                                             'revid'])
+
 def get_summary(title):
-    summary=""
+    return get_summaries([title])[title].summary
 
-    print(f'Getting summary for {title}')
+# Returns a dict of title -> SummaryResult, fetched in batches
+def get_summaries(titles):
+    summaries = {}
+
+    log.debug(f'Getting summaries for {len(titles)} titles starting with {titles[0]}')
 
     try:
-        page = wikipedia.page(title, pageid=None, auto_suggest=False,
-                              redirect=False, preload=False)
-        summary = page.summary
-    except wikipedia.exceptions.RedirectError:
-        print(f'Skipping title ${title} because it will redirect')
-    except wikipedia.exceptions.PageError:
-        print(f'Skipping title ${title} because of PageError')
-    except KeyError:
-        print("Skipping due to KeyError")
-
-    return summary
+        infos = wiki_api.get_page_infos(titles)
+    except (requests.RequestException, wiki_api.ApiError) as e:
+        log.warning(f'Skipping {len(titles)} titles due to {e!r}')
+        return {title: SummaryResult("", 'error', type(e).__name__, title, None, None)
+                for title in titles}
+
+    title_aliases.record(infos)
 
+    for title, info in infos.items():
+        if info.error == 'redirect':
+            log.debug(f'Skipping title ${title} because it will redirect')
+            summaries[title] = SummaryResult("", 'redirect', 'RedirectError', info.title,
+                                             info.pageid, info.revid)
+        elif info.error == 'missing':
+            log.debug(f'Skipping title ${title} because of PageError')
+            summaries[title] = SummaryResult("", 'missing', 'PageError', title, None, None)
+        else:
+            summaries[title] = SummaryResult(info.summary, 'ok', None, info.title,
+                                             info.pageid, info.revid)
+
+    return summaries
+
+# Streams the people in 'fname' and inserts those that meet the reference
+# count threshold and are not yet in the DB.  Rows are written with one
+# connection, summary_insert_batch_size at a time, committing once per
+# batch, so a killed run loses at most the batch in flight and a re-run
+# picks up where it left off.
 def insert_summaries_for_file(fname):
-    if not os.path.exists(fname):
+    if not wiki_by_birth_year.have_people_file(fname):
         print(f'ERROR: file {fname} was not found')
         return False
 
     db_wrapper.initialize_tables()
 
     good = 0
-    skip_low_ref = 0
     skip_already_have = 0
 
-    for title, ref_count, year in wiki_by_birth_year.iterate_people_file(fname):
-        if ref_count >= cfg.min_ref_count_for_summary:
-            with db_wrapper.DBManager() as cur:
-                res = cur.execute("select title from people where title = ?", (title,) )
-
-                if res.fetchone():
-                    print(f'Summary for {title} already exists in the DB; skipping')
-                    sys.stdout.flush()
-                    skip_already_have += 1
-                else:
-                    summary = get_summary(title)
-                    cur.execute("insert or ignore into people values (?, ?, ?, ?, ?)",
-                                (title, year, ref_count, summary, None))
-                    good += 1
-        else:
-            skip_low_ref += 1
+    with db_wrapper.DBManager() as cur, metrics.timer('stage_seconds', stage='summaries'):
+        # birth year -> set of titles already in the DB
+        existing = {}
+        batch = []
 
+        people = wiki_by_birth_year.load_people_columns(fname)
+        above = people.above(cfg.min_ref_count_for_summary)
+
+        for title, ref_count, year in above:
+            if year not in existing:
+                res = cur.execute("select title from people where birth_year = ?", (year,))
+                existing[year] = {row[0] for row in res}
+
+            if title in existing[year]:
+                log.debug(f'Summary for {title} already exists in the DB; skipping')
+                skip_already_have += 1
+                continue
+
+            existing[year].add(title)
+            batch.append((title, ref_count, year))
+
+            if len(batch) >= cfg.summary_insert_batch_size:
+                inserted = insert_batch(cur, batch)
+                good += inserted
+                skip_already_have += len(batch) - inserted
+                batch = []
+
+        if batch:
+            inserted = insert_batch(cur, batch)
+            good += inserted
+            skip_already_have += len(batch) - inserted
+
+    skip_low_ref = len(people) - good - skip_already_have
     print(f'Inserted {good} good entries, skipped {skip_low_ref} low reference entries, '
           f'{skip_already_have} entries we already have')
+
+    estimated = people.estimated_above(cfg.min_ref_count_for_summary)
+    if estimated:
+        print(f'WARNING: {estimated} people in {fname} might meet the threshold but their '
+              f'reference counts were only estimated; delete the file to count them exactly')
     print(f'Database now contains {db_wrapper.get_people_count()} people')
 
     return True
 
+# Fetches summaries for a batch of (title, ref_count, year) and inserts
+# them in one transaction, under the canonical title of each page.  Returns
+# the number of rows inserted, which can be less than the batch size if a
+# page is already in the DB under another birth year or another title.
+def insert_batch(cur, batch):
+    canonical = title_aliases.canonical_titles([title for title, _, _ in batch])
+    batch = [(canonical[title], ref_count, year) for title, ref_count, year in batch]
+
+    # Don't fetch pages already in the DB under their canonical title,
+    # e.g. from another birth year
+    titles = list(set(canonical.values()))
+    marks = ','.join('?' * len(titles))
+    res = cur.execute(f"select title from people where title in ({marks})", titles)
+    have = {row[0] for row in res}
+    batch = [person for person in batch if person[0] not in have]
+
+    if not batch:
+        return 0
+
+    summaries = get_summaries([title for title, _, _ in batch])
+
+    query = '''
+        insert or ignore into people (title, birth_year, reference_count, summary, image_fname,
+                                      summary_status, summary_attempts, summary_error,
+                                      pageid, lastrevid)
+        values (?, ?, ?, ?, NULL, ?, 1, ?, ?, ?)
+        '''
+    rows = []
+    for title, ref_count, year in batch:
+        summary = summaries[title]
+        rows.append((summary.title, year, ref_count, summary.summary, summary.status,
+                     summary.error, summary.pageid, summary.revid))
+
+    cur.executemany(query, rows)
+    inserted = cur.rowcount
+    db_wrapper.commit(cur)
+    metrics.increment('rows', inserted, stage='summaries')
+
+    return inserted
+
+# Fetches the summaries again for everyone whose summary failed with a
+# retryable error and has been tried fewer than max_fetch_attempts times.
+# Titles that redirect are renamed to the page they redirect to, or merged
+# into it if that page is already in the DB.
+def retry_failed_summaries():
+    with db_wrapper.DBManager() as cur:
+        query = '''
+            select title from people
+            where summary_status in ('redirect', 'error') and summary_attempts < ?
+            '''
+        titles = [row[0] for row in cur.execute(query, (cfg.max_fetch_attempts,))]
+
+    print(f'Retrying the summaries of {len(titles)} people')
+
+    fixed = 0
+    merged = 0
+    batch_size = cfg.summary_insert_batch_size
+
+    with db_wrapper.DBManager() as cur, metrics.timer('stage_seconds', stage='summaries'):
+        for start in range(0, len(titles), batch_size):
+            batch = titles[start:start + batch_size]
+
+            try:
+                resolved = title_aliases.resolve(batch)
+                canonical = {title: resolved[title][0] for title in batch}
+            except (requests.RequestException, wiki_api.ApiError) as e:
+                log.warning(f'Could not resolve redirects for {len(batch)} titles due to {e!r}')
+                canonical = {title: title for title in batch}
+
+            refetch, merged_batch = merge_redirects(cur, canonical)
+            merged += merged_batch
+
+            if refetch:
+                fixed += update_summaries(cur, get_summaries(refetch))
+            db_wrapper.commit(cur)
+
+    print(f'Fixed {fixed} summaries, merged {merged} redirects into people we already have')
+
+# 'canonical' is a dict of title -> the title it redirects to.  Renames
+# each redirecting person to their canonical title, or deletes them if the
+# canonical title is already in the DB.  Returns (titles to fetch the
+# summary of, number of people merged).
+def merge_redirects(cur, canonical):
+    refetch = []
+    merged = 0
+
+    for title, target in canonical.items():
+        if title == target:
+            refetch.append(title)
+            continue
+
+        # Professions are assigned again by the next update_professions,
+        # even if fetching the summary fails
+        cur.execute("delete from people_to_profession where title = ?", (title,))
+
+        if cur.execute("select 1 from people where title = ?", (target,)).fetchone():
+            log.info(f'Merging {title} into {target}, which it redirects to')
+            cur.execute("delete from people where title = ?", (title,))
+            merged += 1
+        else:
+            log.info(f'Renaming {title} to {target}, which it redirects to')
+            cur.execute('''
+                update people
+                set title = ?, image_fname = NULL, tagged_at = NULL,
+                    image_status = 'error', image_error = 'RedirectError'
+                where title = ?
+                ''', (target, title))
+            refetch.append(target)
+
+    return list(dict.fromkeys(refetch)), merged
+
+# Stores a dict of title -> SummaryResult and marks the people for
+# profession assignment.  Returns the number of summaries now fetched.
+def update_summaries(cur, summaries):
+    query = '''
+        update people
+        set summary = ?, summary_status = ?, summary_error = ?,
+            summary_attempts = summary_attempts + 1, tagged_at = NULL,
+            pageid = coalesce(?, pageid), lastrevid = coalesce(?, lastrevid)
+        where title = ?
+        '''
+    cur.executemany(query, [(summary.summary, summary.status, summary.error,
+                             summary.pageid, summary.revid, title)
+                            for title, summary in summaries.items()])
+
+    fixed = sum(summary.status == 'ok' for summary in summaries.values())
+    metrics.increment('rows', fixed, stage='summaries')
+    return fixed
+
+# Brings the people already in the DB up to date with Wikipedia.  The
+# latest revision of every page is checked, 50 pages per request, and only
+# pages that changed since they were fetched are fetched again.  Their
+# summary and reference count are replaced, their images are marked stale
+# and their professions will be assigned again.  People fetched before
+# revisions were recorded are all fetched again once.
+def refresh_people():
+    with db_wrapper.DBManager() as cur:
+        rows = cur.execute("select title, pageid, lastrevid from people").fetchall()
+
+    print(f'Checking {len(rows)} people for changes')
+
+    known = [row for row in rows if row[1] is not None and row[2] is not None]
+    changed = [title for title, pageid, lastrevid in rows if pageid is None or lastrevid is None]
+    moved = {}
+    gone = []
+
+    batch_size = wiki_api.MAX_TITLES_PER_REQUEST
+    for start in range(0, len(known), batch_size):
+        batch = known[start:start + batch_size]
+        try:
+            revisions = wiki_api.get_latest_revisions([pageid for _, pageid, _ in batch])
+        except (requests.RequestException, wiki_api.ApiError) as e:
+            # Their revisions are left as they were, so the next refresh checks them again
+            log.warning(f'Skipping {len(batch)} titles due to {e!r}')
+            metrics.increment('skipped_rows', len(batch), stage='refresh')
+            continue
+
+        for title, pageid, lastrevid in batch:
+            if pageid not in revisions:
+                gone.append(title)
+                continue
+
+            current_title, revid = revisions[pageid]
+            if current_title != title:
+                moved[title] = current_title
+            elif revid != lastrevid:
+                changed.append(title)
+
+    for title in gone:
+        log.info(f'The page of {title} no longer exists')
+
+    # Pages that were moved are fetched under their new title
+    with db_wrapper.DBManager() as cur:
+        renamed, _ = merge_redirects(cur, moved)
+        changed.extend(renamed)
+
+    print(f'{len(changed)} pages changed, {len(moved)} moved and {len(gone)} deleted')
+
+    refreshed = 0
+    batch_size = cfg.summary_insert_batch_size
+
+    with db_wrapper.DBManager() as cur, metrics.timer('stage_seconds', stage='refresh'):
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start:start + batch_size]
+
+            try:
+                refreshed += refresh_batch(cur, batch)
+            except (requests.RequestException, wiki_api.ApiError) as e:
+                # Their revisions are unchanged, so the next refresh tries again
+                log.warning(f'Skipping {len(batch)} titles due to {e!r}')
+                metrics.increment('skipped_rows', len(batch), stage='refresh')
+            db_wrapper.commit(cur)
+
+    print(f'Refreshed {refreshed} people')
+
+# Fetches the pages of 'titles' again, bypassing the response cache, and
+# replaces what we have for them.  Returns the number of people updated.
+def refresh_batch(cur, titles):
+    http_cache.invalidate(titles)
+    infos = wiki_api.get_page_infos(titles)
+    title_aliases.record(infos)
+
+    infos = {title: info for title, info in infos.items() if info.error is None}
+    merge_redirects(cur, {title: info.title for title, info in infos.items()})
+
+    query = '''
+        update people
+        set summary = ?, reference_count = ?, pageid = ?, lastrevid = ?,
+            summary_status = 'ok', summary_error = NULL, tagged_at = NULL,
+            image_status = CASE WHEN image_status IS NULL THEN NULL ELSE 'stale' END
+        where title = ?
+        '''
+    cur.executemany(query, [(info.summary, info.ref_count, info.pageid, info.revid, info.title)
+                            for info in infos.values()])
+    metrics.increment('rows', len(infos), stage='refresh')
+
+    return len(infos)
+
 # For all people born in 'year', with reference count above a threshold, does a wiki
 # lookup on the page to get the summary and inserts the information
 # into the 'people' table